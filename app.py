@@ -1,55 +1,170 @@
 from flask import Flask, render_template, request, send_file, jsonify
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, join_room
 import os
 import shutil
 from werkzeug.utils import secure_filename
 import uuid
-from celery_app import process_video_task
+from celery_app import process_video_task, process_stream_task, replay_variant_task, dispatch_job
+from video_processing import (CONTENT_STORE_DIR, new_content_hasher, is_streamable_mp4, parse_renditions,
+                              estimate_job_cost, load_recipe_manifest, replay_source)
+from upload_session import (load_session_info, save_session_info, partial_upload_path, create_received_map,
+                            mark_chunk_received, missing_chunks)
+from progress_events import REDIS_URL
+from storage_manager import record_session, touch_session, index_unknown_sessions, sweep
 from datetime import datetime, timedelta
-import json
 import math
+import threading
 
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Workers emit progress through the Redis message queue (see progress_events);
+# the web tier runs as a single eventlet worker, which Flask-SocketIO needs
+# without sticky sessions
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=REDIS_URL)
 
 app.config['MAX_CONTENT_LENGTH'] = 2048 * 1024 * 1024  # 2GB max file size
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['OUTPUT_FOLDER'] = 'output'
-app.config['FILE_RETENTION_HOURS'] = 1  # Files older than this will be deleted
+app.config['CONTENT_STORE_FOLDER'] = CONTENT_STORE_DIR  # Cleaned sources keyed by upload hash
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024  # Default chunk size offered to clients
+app.config['UPLOAD_CHUNK_SIZE_MIN'] = 1024 * 1024
+app.config['UPLOAD_CHUNK_SIZE_MAX'] = 16 * 1024 * 1024
+app.config['UPLOAD_CONCURRENCY'] = 4  # Chunks a client may have in flight at once
+app.config['FILE_RETENTION_HOURS'] = 1  # Sessions idle for longer than this are deleted
+app.config['OUTPUT_CACHE_MAX_BYTES'] = int(os.environ.get('OUTPUT_CACHE_MAX_BYTES', 20 * 1024 ** 3))  # LRU-evicted above this
+app.config['STORAGE_SWEEP_SECONDS'] = 60
+app.config['FANOUT_VARIANTS'] = os.environ.get('FANOUT_VARIANTS', '0') == '1'  # Encode all copies from one decode
+app.config['VARIANT_TRANSFORMS'] = int(os.environ.get('VARIANT_TRANSFORMS', '0'))  # Random transforms per copy
+app.config['SEGMENT_SECONDS'] = int(os.environ.get('SEGMENT_SECONDS', '0'))  # Segment-parallel encode, 0 = off
+app.config['QUALITY_TARGET'] = float(os.environ.get('QUALITY_TARGET', '0'))  # Quality floor for CRF selection, 0 = off
+app.config['QUALITY_METRIC'] = os.environ.get('QUALITY_METRIC', 'ssim')  # 'ssim' (0-1) or 'vmaf' (0-100)
 
 # Ensure upload and output directories exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 
+@socketio.on('join')
+def join_session(data):
+    session_id = (data or {}).get('session_id')
+    if session_id:
+        join_room(secure_filename(session_id))
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'mp4', 'mov'}
 
-def cleanup_old_files():
-    """Delete files older than FILE_RETENTION_HOURS"""
-    cutoff = datetime.now() - timedelta(hours=app.config['FILE_RETENTION_HOURS'])
-    
-    # Clean up upload directory
-    for session_id in os.listdir(app.config['UPLOAD_FOLDER']):
-        session_path = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+def parse_job_options(data):
+    """Validated copies/orientation/bitstream among data's keys; raises ValueError"""
+    options = {}
+    if 'copies' in data:
         try:
-            if os.path.getctime(session_path) < cutoff.timestamp():
-                shutil.rmtree(session_path, ignore_errors=True)
-        except Exception as e:
-            print(f"Error cleaning up upload directory {session_path}: {str(e)}")
+            options['copies'] = int(data['copies'])
+        except (TypeError, ValueError):
+            raise ValueError('Number of copies must be an integer')
+        if options['copies'] < 1 or options['copies'] > 5:
+            raise ValueError('Number of copies must be between 1 and 5')
+    if 'orientation' in data:
+        if data['orientation'] not in ('horizontal', 'vertical'):
+            raise ValueError('Orientation must be horizontal or vertical')
+        options['orientation'] = data['orientation']
+    if 'bitstream' in data:
+        # Same opt-in as upload_file's form field; JSON clients may send true
+        options['bitstream'] = data['bitstream'] in (True, '1')
+    if 'renditions' in data:
+        try:
+            options['renditions'] = parse_renditions(data['renditions'])
+        except TypeError:
+            raise ValueError('Renditions must be a list or comma-separated string')
+    return options
+
+def copy_and_hash(src, dst, hasher, block_size=1024 * 1024):
+    """Copy the src stream into dst in blocks, feeding every block to hasher"""
+    while True:
+        block = src.read(block_size)
+        if not block:
+            break
+        hasher.update(block)
+        dst.write(block)
+
+def preallocate(path, size):
+    """Create path with size bytes reserved so chunks can be written in place"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if size > 0:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+def write_at(data, path, offset):
+    """pwrite data into path starting at offset"""
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    finally:
+        os.close(fd)
+
+def cleanup_content_store():
+    """Delete stored sources that no job has reused within FILE_RETENTION_HOURS"""
+    cutoff = datetime.now() - timedelta(hours=app.config['FILE_RETENTION_HOURS'])
+    store = app.config['CONTENT_STORE_FOLDER']
+    if os.path.isdir(store):
+        for content_hash in os.listdir(store):
+            entry_path = os.path.join(store, content_hash)
+            try:
+                # Reused entries get their files' mtime refreshed by the worker
+                last_used = max([os.path.getmtime(entry_path)] +
+                                [os.path.getmtime(os.path.join(entry_path, f)) for f in os.listdir(entry_path)])
+                if last_used < cutoff.timestamp():
+                    shutil.rmtree(entry_path, ignore_errors=True)
+            except Exception as e:
+                print(f"Error cleaning up content store {entry_path}: {str(e)}")
+
+_sweeper_lock = threading.Lock()
+_sweeper_started = False
 
-    # Clean up output directory
-    for session_id in os.listdir(app.config['OUTPUT_FOLDER']):
-        session_path = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
+def sweep_storage():
+    """Evict idle and least recently used sessions in the background, off the request path"""
+    roots = (app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER'])
+    interval = app.config['STORAGE_SWEEP_SECONDS']
+    try:
+        index_unknown_sessions(roots)
+    except Exception as e:
+        print(f"[STORAGE] Error indexing sessions: {str(e)}")
+    while True:
         try:
-            if os.path.getctime(session_path) < cutoff.timestamp():
-                shutil.rmtree(session_path, ignore_errors=True)
+            evicted = sweep(roots, app.config['OUTPUT_CACHE_MAX_BYTES'],
+                            app.config['FILE_RETENTION_HOURS'] * 3600, interval)
+            # None means another web process swept within this interval
+            if evicted is not None:
+                if evicted:
+                    print(f"[STORAGE] Evicted sessions: {evicted}")
+                cleanup_content_store()
         except Exception as e:
-            print(f"Error cleaning up output directory {session_path}: {str(e)}")
+            print(f"[STORAGE] Sweep error: {str(e)}")
+        socketio.sleep(interval)
+
+def ensure_storage_sweeper():
+    global _sweeper_started
+    with _sweeper_lock:
+        if not _sweeper_started:
+            socketio.start_background_task(sweep_storage)
+            _sweeper_started = True
+
+def index_session(session_id, *dirs):
+    # The index is best effort; a missing entry is picked up by the next sweeper start
+    try:
+        record_session(session_id, *dirs)
+    except Exception as e:
+        print(f"[STORAGE] Error indexing session {session_id}: {str(e)}")
 
 @app.route('/')
 def index():
-    # Run cleanup on each homepage visit
-    cleanup_old_files()
+    ensure_storage_sweeper()
     return render_template('index.html')
 
 @app.route('/upload', methods=['POST'])
@@ -70,6 +185,13 @@ def upload_file():
     if copies < 1 or copies > 5:
         return jsonify({'error': 'Number of copies must be between 1 and 5'}), 400
 
+    try:
+        renditions = parse_renditions(request.form.get('renditions', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # Remux-only copies: much cheaper, but only bitstream/container-level changes
+    bitstream = request.form.get('bitstream') == '1'
+
     # Create unique session ID for this upload
     session_id = str(uuid.uuid4())
     session_input_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
@@ -82,10 +204,24 @@ def upload_file():
         # Save uploaded file
         filename = secure_filename(file.filename)
         input_path = os.path.join(session_input_dir, filename)
-        file.save(input_path)
-
-        # Start async processing
-        task = process_video_task.delay(session_input_dir, session_output_dir, copies, orientation)
+        hasher = new_content_hasher()
+        with open(input_path, 'wb') as outfile:
+            copy_and_hash(file.stream, outfile, hasher)
+        ensure_storage_sweeper()
+        index_session(session_id, session_input_dir, session_output_dir)
+
+        # Start async processing, routed by estimated cost
+        cost = estimate_job_cost(input_path, copies, renditions, bitstream=bitstream)
+        task = dispatch_job(process_video_task, cost,
+                            session_input_dir, session_output_dir, copies, orientation,
+                            fanout=app.config['FANOUT_VARIANTS'],
+                            num_transforms=app.config['VARIANT_TRANSFORMS'],
+                            segment_seconds=app.config['SEGMENT_SECONDS'],
+                            content_hash=hasher.hexdigest(),
+                            renditions=renditions,
+                            quality_target=app.config['QUALITY_TARGET'],
+                            quality_metric=app.config['QUALITY_METRIC'],
+                            bitstream=bitstream)
 
         return jsonify({
             'success': True,
@@ -113,6 +249,9 @@ def get_task_status(task_id):
             response['status'] = 'Task is pending...'
         elif task.state == 'PROCESSING':
             response['status'] = task.info.get('status', 'Processing video...')
+            for key in ('percent', 'eta'):
+                if key in task.info:
+                    response[key] = task.info[key]
         elif task.state == 'SUCCESS':
             print(f"[STATUS] Task {task_id} success info: {task.info}")
             if task.info is None:
@@ -151,26 +290,44 @@ def download_file(session_id, filename):
         if not os.path.exists(file_path):
             return jsonify({'error': 'File not found'}), 404
 
-        # Send file for download
-        response = send_file(file_path, as_attachment=True)
-        
-        # Delete files after successful download
-        @response.call_on_close
-        def cleanup():
-            try:
-                # Clean up input directory
-                input_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
-                if os.path.exists(input_dir):
-                    shutil.rmtree(input_dir)
-                
-                # Clean up output directory
-                output_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
-                if os.path.exists(output_dir):
-                    shutil.rmtree(output_dir)
-            except Exception as e:
-                print(f"Error cleaning up files for session {session_id}: {str(e)}")
-        
-        return response
+        # Files stay for the session's other downloads; the storage sweeper evicts
+        # the session once it is idle or the cache is over its size limit
+        try:
+            touch_session(secure_filename(session_id))
+        except Exception as e:
+            print(f"[STORAGE] Error touching session {session_id}: {str(e)}")
+
+        return send_file(file_path, as_attachment=True)
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/replay/<session_id>/<filename>', methods=['POST'])
+def replay_file(session_id, filename):
+    """Rebuild one output of a session from the recipe recorded when it was made"""
+    try:
+        session_id = secure_filename(session_id)
+        secure_name = secure_filename(filename)
+        session_input_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+        session_output_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
+
+        entry = load_recipe_manifest(session_output_dir).get(secure_name)
+        # Fallback copies of the upload have no recipe to rebuild from
+        if entry is None or entry.get('recipe') is None:
+            return jsonify({'error': 'No recipe recorded for this file'}), 404
+        try:
+            source = replay_source(entry, session_input_dir)
+        except FileNotFoundError as e:
+            return jsonify({'error': str(e)}), 410
+
+        cost = estimate_job_cost(source, 1, [entry['rendition']] if entry.get('rendition') else None)
+        task = dispatch_job(replay_variant_task, cost, session_input_dir, session_output_dir, secure_name)
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'task_id': task.id,
+            'recipe': entry['recipe']
+        })
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -186,6 +343,15 @@ def start_upload():
         if not filename or not allowed_file(filename):
             return jsonify({'error': 'Invalid file type. Only MP4 and MOV files are allowed'}), 400
 
+        try:
+            options = parse_job_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        filesize = int(data.get('filesize', 0))
+        if filesize <= 0 or filesize > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({'error': 'Invalid file size'}), 400
+
         # Create unique session ID and directories
         session_id = str(uuid.uuid4())
         session_input_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
@@ -194,23 +360,39 @@ def start_upload():
         os.makedirs(session_input_dir, exist_ok=True)
         os.makedirs(session_output_dir, exist_ok=True)
 
-        # Create temporary upload directory for chunks
-        upload_dir = os.path.join(session_input_dir, 'chunks')
-        os.makedirs(upload_dir, exist_ok=True)
-
         # Store session info
+        chunk_size = int(data.get('chunk_size', app.config['UPLOAD_CHUNK_SIZE']))
+        chunk_size = min(max(chunk_size, app.config['UPLOAD_CHUNK_SIZE_MIN']), app.config['UPLOAD_CHUNK_SIZE_MAX'])
         session_info = {
             'filename': secure_filename(filename),
-            'orientation': data.get('orientation', 'horizontal'),
-            'copies': int(data.get('copies', 1)),
-            'total_chunks': math.ceil(int(data.get('filesize', 0)) / (1024 * 1024))  # 1MB chunks
+            'orientation': options.get('orientation', 'horizontal'),
+            'copies': options.get('copies', 1),
+            'renditions': options.get('renditions', []),
+            'bitstream': options.get('bitstream', False),
+            'filesize': filesize,
+            'chunk_size': chunk_size,
+            'total_chunks': math.ceil(filesize / chunk_size),
+            # Opt-in: start processing from the first chunk for faststart/fragmented MP4
+            'stream': bool(data.get('stream', False))
         }
 
+        # Chunks are written straight into the preallocated target at their offset
+        preallocate(partial_upload_path(session_input_dir, session_info), filesize)
+
+        # Received-chunk map, persisted so an interrupted upload can resume
+        create_received_map(session_input_dir, session_info['total_chunks'])
+
         # Save session info
-        with open(os.path.join(session_input_dir, 'session_info.json'), 'w') as f:
-            json.dump(session_info, f)
+        save_session_info(session_input_dir, session_info)
+        ensure_storage_sweeper()
+        index_session(session_id, session_input_dir)
 
-        return jsonify({'session_id': session_id})
+        return jsonify({
+            'session_id': session_id,
+            'chunk_size': chunk_size,
+            'total_chunks': session_info['total_chunks'],
+            'concurrency': app.config['UPLOAD_CONCURRENCY']
+        })
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -229,51 +411,157 @@ def upload_chunk(session_id):
         if not os.path.exists(session_input_dir):
             return jsonify({'error': 'Invalid session'}), 400
 
-        # Save chunk
-        chunks_dir = os.path.join(session_input_dir, 'chunks')
-        chunk_path = os.path.join(chunks_dir, f'chunk_{chunk_number}')
-        chunk.save(chunk_path)
+        session_info = load_session_info(session_input_dir)
+
+        if chunk_number < 0 or chunk_number >= max(session_info['total_chunks'], 1):
+            return jsonify({'error': 'Invalid chunk number'}), 400
+
+        # Every chunk but the last is exactly chunk_size; a short or long body
+        # must not be marked received or spill into the next chunk
+        offset = chunk_number * session_info['chunk_size']
+        expected = min(session_info['chunk_size'], session_info['filesize'] - offset)
+        body = chunk.stream.read(expected + 1)
+        if len(body) != expected:
+            return jsonify({'error': f'Chunk {chunk_number} must be {expected} bytes'}), 400
+
+        # Write chunk in place
+        write_at(body, partial_upload_path(session_input_dir, session_info), offset)
+        mark_chunk_received(session_input_dir, chunk_number)
+
+        # An upload in progress is in use: the sweeper must not take its .part file
+        try:
+            touch_session(secure_filename(session_id))
+        except Exception as e:
+            print(f"[STORAGE] Error touching session {session_id}: {str(e)}")
+
+        if chunk_number == 0 and session_info.get('stream') and not session_info.get('stream_task_id'):
+            start_streaming(session_id, session_input_dir, session_info)
 
         return jsonify({'success': True})
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def start_streaming(session_id, session_input_dir, session_info):
+    """Start processing from the growing upload if its header and options allow it"""
+    # The stream task only writes plain variants; renditions and bitstream jobs wait for the full upload
+    if session_info.get('renditions') or session_info.get('bitstream'):
+        print(f"[STREAM] Session {session_id} asked for renditions/bitstream, waiting for full upload")
+        session_info['stream'] = False
+        save_session_info(session_input_dir, session_info)
+        return
+
+    with open(partial_upload_path(session_input_dir, session_info), 'rb') as f:
+        header = f.read(session_info['chunk_size'])
+
+    if not is_streamable_mp4(header):
+        print(f"[STREAM] Session {session_id} is not faststart/fragmented, waiting for full upload")
+        session_info['stream'] = False
+        save_session_info(session_input_dir, session_info)
+        return
+
+    session_output_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
+    # The moov atom is in the header, so the growing file can usually be probed already
+    cost = estimate_job_cost(partial_upload_path(session_input_dir, session_info), session_info['copies'],
+                             filesize=session_info['filesize'])
+    task = dispatch_job(
+        process_stream_task,
+        cost,
+        session_input_dir,
+        session_output_dir,
+        session_info['copies'],
+        session_info['orientation'],
+        num_transforms=app.config['VARIANT_TRANSFORMS']
+    )
+    print(f"[STREAM] Session {session_id} streaming into task {task.id}")
+    session_info['stream_task_id'] = task.id
+    save_session_info(session_input_dir, session_info)
+
+@app.route('/upload/status/<session_id>')
+def upload_status(session_id):
+    try:
+        session_input_dir = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(session_id))
+        if not os.path.exists(os.path.join(session_input_dir, 'session_info.json')):
+            return jsonify({'error': 'Invalid session'}), 404
+
+        session_info = load_session_info(session_input_dir)
+        if not os.path.exists(partial_upload_path(session_input_dir, session_info)):
+            return jsonify({'error': 'Upload already completed'}), 409
+
+        missing = missing_chunks(session_input_dir, session_info['total_chunks'])
+        index_session(secure_filename(session_id), session_input_dir)
+        return jsonify({
+            'session_id': session_id,
+            'filesize': session_info['filesize'],
+            'chunk_size': session_info['chunk_size'],
+            'total_chunks': session_info['total_chunks'],
+            'received_chunks': session_info['total_chunks'] - len(missing),
+            'missing_chunks': missing,
+            'concurrency': app.config['UPLOAD_CONCURRENCY']
+        })
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/upload/complete/<session_id>', methods=['POST'])
 def complete_upload(session_id):
+    # A resumed upload may pick different options than the original start.
+    # Checked before anything else: a bad option must not cost the upload
+    try:
+        options = parse_job_options(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     try:
         session_input_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
         session_output_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
-        chunks_dir = os.path.join(session_input_dir, 'chunks')
+        session_info_path = os.path.join(session_input_dir, 'session_info.json')
 
-        if not os.path.exists(session_input_dir) or not os.path.exists(chunks_dir):
+        if not os.path.exists(session_info_path):
             return jsonify({'error': 'Invalid session'}), 400
 
         # Load session info
-        with open(os.path.join(session_input_dir, 'session_info.json'), 'r') as f:
-            session_info = json.load(f)
-
-        # Combine chunks
-        output_path = os.path.join(session_input_dir, session_info['filename'])
-        with open(output_path, 'wb') as outfile:
-            chunk_number = 0
-            while True:
-                chunk_path = os.path.join(chunks_dir, f'chunk_{chunk_number}')
-                if not os.path.exists(chunk_path):
-                    break
-                with open(chunk_path, 'rb') as chunk_file:
-                    outfile.write(chunk_file.read())
-                chunk_number += 1
-
-        # Clean up chunks
-        shutil.rmtree(chunks_dir)
-
-        # Start async processing
-        task = process_video_task.delay(
+        session_info = load_session_info(session_input_dir)
+
+        # Chunks are already in place, completing is just a rename
+        partial_path = partial_upload_path(session_input_dir, session_info)
+        if not os.path.exists(partial_path):
+            return jsonify({'error': 'Invalid session'}), 400
+
+        missing = missing_chunks(session_input_dir, session_info['total_chunks'])
+        if missing:
+            return jsonify({'error': 'Upload is incomplete', 'missing_chunks': missing}), 409
+
+        session_info.update(options)
+        session_info.setdefault('bitstream', False)
+        input_path = os.path.join(session_input_dir, session_info['filename'])
+        os.rename(partial_path, input_path)
+        index_session(session_id, session_input_dir, session_output_dir)
+
+        # Already being processed while the upload was arriving
+        if session_info.get('stream_task_id'):
+            return jsonify({
+                'success': True,
+                'task_id': session_info['stream_task_id']
+            })
+
+        # Start async processing, routed by estimated cost
+        cost = estimate_job_cost(input_path, session_info['copies'], session_info.get('renditions'),
+                                 bitstream=session_info['bitstream'])
+        task = dispatch_job(
+            process_video_task,
+            cost,
             session_input_dir, 
             session_output_dir, 
             session_info['copies'], 
-            session_info['orientation']
+            session_info['orientation'],
+            fanout=app.config['FANOUT_VARIANTS'],
+            num_transforms=app.config['VARIANT_TRANSFORMS'],
+            segment_seconds=app.config['SEGMENT_SECONDS'],
+            renditions=session_info.get('renditions', []),
+            quality_target=app.config['QUALITY_TARGET'],
+            quality_metric=app.config['QUALITY_METRIC'],
+            bitstream=session_info['bitstream']
         )
 
         return jsonify({
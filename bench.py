@@ -0,0 +1,237 @@
+"""Benchmarks for video_processing on deterministic synthetic inputs.
+
+    python bench.py run [--out bench.json] [--baseline baseline.json]
+    python bench.py compare bench.json baseline.json
+
+Inputs are generated once with ffmpeg testsrc2/sine into --work-dir. Every
+case runs under a fixed random seed, in a process of its own, and records
+wall time, CPU time and peak RSS of the ffmpeg children, bytes read/written
+by them, output size and frames per second.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import video_processing as vp
+
+# name: (width, height, seconds, with audio, container)
+SYNTHETIC_INPUTS = {
+    'hd_10s': (1920, 1080, 10, True, 'mp4'),
+    'sd_5s': (640, 360, 5, True, 'mp4'),
+    'odd_dims_3s': (641, 359, 3, True, 'mp4'),
+    'no_audio_5s': (1280, 720, 5, False, 'mp4'),
+    'vertical_5s': (720, 1280, 5, True, 'mov'),
+}
+TRANSFORM_INPUT = 'sd_5s'
+# Compared against the baseline; a relative increase above the threshold is a regression
+COMPARED_METRICS = ('wall_seconds', 'cpu_seconds', 'output_bytes')
+
+def make_input(name, work_dir):
+    width, height, seconds, audio, ext = SYNTHETIC_INPUTS[name]
+    path = os.path.join(work_dir, f"{name}.{ext}")
+    if os.path.exists(path):
+        return path
+    cmd = [
+        "ffmpeg", "-y", "-nostdin",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate=30:duration={seconds}",
+    ]
+    if audio:
+        cmd.extend(["-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={seconds}",
+                    "-c:a", "aac", "-b:a", "128k"])
+    # 4:2:0 needs even dimensions, odd-sized inputs are stored as 4:4:4
+    pix_fmt = "yuv420p" if width % 2 == 0 and height % 2 == 0 else "yuv444p"
+    cmd.extend([
+        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", pix_fmt,
+        "-fflags", "+bitexact", "-flags:v", "+bitexact", "-flags:a", "+bitexact",
+        path
+    ])
+    vp.run_process(cmd, check=True, capture_output=True)
+    return path
+
+def _children_usage():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+def measure(name, func, input_video, outputs, seed):
+    """Run func() under a fixed seed and collect its metrics"""
+    random.seed(seed)
+    before = _children_usage()
+    self_before = time.process_time()
+    started = time.perf_counter()
+    error = None
+    try:
+        func()
+    except Exception as e:
+        error = str(e)
+    wall = time.perf_counter() - started
+    after = _children_usage()
+
+    written = [path for path in outputs() if os.path.exists(path)]
+    frames = vp.probe_media(input_video).total_frames * max(1, len(written))
+    result = {
+        'case': name,
+        'input': os.path.basename(input_video),
+        'wall_seconds': round(wall, 3),
+        'cpu_seconds': round(time.process_time() - self_before, 3),
+        'output_files': len(written),
+        'output_bytes': sum(os.path.getsize(path) for path in written),
+        'fps': round(frames / wall, 2) if wall > 0 else 0,
+        'error': error,
+    }
+    if before and after:
+        # Blocks are 512 bytes; only I/O that actually hit the disk is counted
+        result['cpu_seconds'] = round(result['cpu_seconds'] + (after.ru_utime - before.ru_utime)
+                                      + (after.ru_stime - before.ru_stime), 3)
+        result['children_peak_rss_kb'] = after.ru_maxrss
+        result['bytes_read'] = (after.ru_inblock - before.ru_inblock) * 512
+        result['bytes_written'] = (after.ru_oublock - before.ru_oublock) * 512
+    print(f"[Bench] {name}: {result['wall_seconds']}s, {result['fps']} fps"
+          + (f", error: {error}" if error else ""))
+    return result
+
+def measure_isolated(name, func, input_video, outputs, seed):
+    """measure() in a forked child process.
+
+    RUSAGE_CHILDREN's ru_maxrss is the peak of every child the process has
+    ever waited for, so in a shared process every case would report the
+    largest peak seen so far.
+    """
+    if not hasattr(os, 'fork'):
+        return measure(name, func, input_video, outputs, seed)
+    ctx = multiprocessing.get_context('fork')
+    reader, writer = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=lambda: writer.send(measure(name, func, input_video, outputs, seed)))
+    process.start()
+    writer.close()
+    try:
+        result = reader.recv()
+    except EOFError:
+        result = {'case': name, 'input': os.path.basename(input_video),
+                  'error': 'benchmark process died'}
+    reader.close()
+    process.join()
+    if process.exitcode:
+        result['error'] = result.get('error') or f'benchmark process exited with {process.exitcode}'
+    return result
+
+def bench_cases(work_dir):
+    """Yield (name, func, input, outputs) for every benchmark case"""
+    for input_name in SYNTHETIC_INPUTS:
+        input_video = make_input(input_name, work_dir)
+        ext = os.path.splitext(input_video)[1]
+
+        output_video = os.path.join(work_dir, 'out', f"unique_{input_name}.mp4")
+        yield (f"generate_unique_video/{input_name}",
+               lambda i=input_video, o=output_video: vp.generate_unique_video(i, o, num_transforms=2),
+               input_video, lambda o=output_video: [o])
+
+        case_dir = os.path.join(work_dir, 'main_modified', input_name)
+        in_dir = os.path.join(case_dir, 'in')
+        out_dir = os.path.join(case_dir, 'out')
+        shutil.rmtree(case_dir, ignore_errors=True)
+        os.makedirs(in_dir)
+        shutil.copy(input_video, os.path.join(in_dir, f"source{ext}"))
+        yield (f"main_modified/{input_name}",
+               lambda i=in_dir, o=out_dir: vp.main_modified(i, o, num_variants=2, num_transforms=2),
+               input_video,
+               lambda o=out_dir: [os.path.join(o, f) for f in os.listdir(o)] if os.path.isdir(o) else [])
+
+    input_video = make_input(TRANSFORM_INPUT, work_dir)
+    for name in sorted(n for n in dir(vp) if n.startswith('apply_')):
+        output_video = os.path.join(work_dir, 'out', f"{name}.mp4")
+        yield (f"{name}/{TRANSFORM_INPUT}",
+               lambda f=getattr(vp, name), o=output_video: f(input_video, o),
+               input_video, lambda o=output_video: [o])
+
+def run_benchmarks(work_dir, seed=1234, only=None):
+    os.makedirs(os.path.join(work_dir, 'out'), exist_ok=True)
+    # Probe once here, every forked case inherits the registry
+    vp.init_encoder_registry()
+    results = []
+    for name, func, input_video, outputs in bench_cases(work_dir):
+        if only and only not in name:
+            continue
+        results.append(measure_isolated(name, func, input_video, outputs, seed))
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'seed': seed,
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': vp.available_cpus(),
+            'encoder': vp.detect_video_encoder(),
+        },
+        'results': results,
+    }
+
+def compare(current, baseline, threshold=0.10):
+    """Print per-case changes against baseline; returns the regressed cases"""
+    base = {r['case']: r for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        old = base.get(result['case'])
+        if old is None:
+            print(f"{result['case']}: new case")
+            continue
+        changes = []
+        for metric in COMPARED_METRICS:
+            before, after = old.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            delta = (after - before) / before
+            changes.append(f"{metric} {before} -> {after} ({delta:+.1%})")
+            if delta > threshold:
+                regressions.append((result['case'], metric, delta))
+        if result.get('error') and not old.get('error'):
+            regressions.append((result['case'], 'error', result['error']))
+        print(f"{result['case']}: " + ', '.join(changes))
+    for case, metric, delta in regressions:
+        print(f"REGRESSION {case}: {metric} {delta if isinstance(delta, str) else f'{delta:+.1%}'}")
+    return regressions
+
+def _load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('run', help='generate inputs and run the benchmarks')
+    run.add_argument('--work-dir', default='bench_work')
+    run.add_argument('--out', default='bench.json')
+    run.add_argument('--seed', type=int, default=1234)
+    run.add_argument('--only', help='run only the cases whose name contains this')
+    run.add_argument('--baseline', help='compare against this result file when done')
+    run.add_argument('--threshold', type=float, default=0.10)
+    cmp = sub.add_parser('compare', help='compare two result files')
+    cmp.add_argument('current')
+    cmp.add_argument('baseline')
+    cmp.add_argument('--threshold', type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        current = run_benchmarks(args.work_dir, args.seed, args.only)
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+        print(f"Results written to {args.out}")
+        if not args.baseline:
+            return 0
+        baseline = _load(args.baseline)
+    else:
+        current, baseline = _load(args.current), _load(args.baseline)
+    return 1 if compare(current, baseline, args.threshold) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
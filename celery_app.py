@@ -1,7 +1,18 @@
-from celery import Celery, states
+from celery import Celery, states, chord
+from celery.exceptions import Ignore
+from celery.utils import uuid
+from celery.signals import worker_process_init, task_prerun, task_postrun
 import os
-import shutil
-from video_processing import main_modified
+import math
+from video_processing import (main_modified, generate_streamed_variants, feed_growing_file, init_encoder_registry,
+                              VariantRecipe, new_seed, variant_seed, recipe_entry, save_recipe_manifest,
+                              load_recipe_manifest, replay_variant, estimate_job_cost,
+                              plan_distributed_variants, encode_variant_item, discard_unverified_outputs,
+                              recorded_job_seed, list_outputs)
+from upload_session import load_session_info, partial_upload_path, contiguous_received_bytes
+from progress_events import publish_progress, record_part_progress
+from process_supervisor import begin_task_scope, end_task_scope
+from storage_manager import pin_session, unpin_session, record_session
 import logging
 import traceback
 import sys
@@ -26,40 +37,187 @@ celery.conf.update(
     task_time_limit=3600,  # 1 hour max
     task_soft_time_limit=3600,
     worker_prefetch_multiplier=1,
-    worker_max_tasks_per_child=1,
+    task_default_queue='small',
+    # Redis emulates priorities with one list per level; 0 is served first
+    broker_transport_options={
+        'priority_steps': list(range(10)),
+        'sep': ':',
+        'queue_order_strategy': 'priority',
+    },
     broker_connection_retry=True,
     broker_connection_max_retries=None,
     task_acks_late=True,  # Only acknowledge after the task is completed
     task_reject_on_worker_lost=True,  # Reject tasks if worker is killed
     worker_max_memory_per_child=1000000,  # Restart worker after 1GB memory used
+    # Child processes probe the encoders in worker_process_init (up to
+    # ENCODER_PROBE_TIMEOUT per ffmpeg run) before reporting alive
+    worker_proc_alive_timeout=float(os.environ.get('WORKER_PROC_ALIVE_TIMEOUT', '120')),
     task_serializer='json',
     result_serializer='json',
     accept_content=['json']
 )
 
+# Jobs are routed by estimated cost (pixel-seconds, see estimate_job_cost) so
+# short clips never wait behind long encodes; workers consume one queue each
+LARGE_JOB_COST = float(os.environ.get('LARGE_JOB_COST', 1280 * 720 * 600))  # ~10 min of 720p
+JOB_QUEUES = {
+    'small': {'soft_time_limit': 900, 'time_limit': 960},
+    'large': {'soft_time_limit': 3600, 'time_limit': 3660},
+}
+
+def job_priority(cost):
+    """Shortest job first within a queue: cheaper jobs get a lower (earlier) priority"""
+    if cost < LARGE_JOB_COST:
+        return min(9, int(10 * cost / LARGE_JOB_COST))
+    return min(9, int(math.log2(cost / LARGE_JOB_COST)))
+
+def route_job(cost):
+    """apply_async routing options (queue, priority, time limits) for a job"""
+    queue = 'large' if cost >= LARGE_JOB_COST else 'small'
+    return dict(queue=queue, priority=job_priority(cost), **JOB_QUEUES[queue])
+
+# Seconds a dispatched job's session stays pinned while it waits in a queue
+QUEUED_PIN_SECONDS = int(os.environ.get('QUEUED_PIN_SECONDS', 6 * 3600))
+
+def dispatch_job(task, cost, *args, **kwargs):
+    """apply_async with cost-based routing; the session is pinned from here, not only once a worker starts"""
+    route = route_job(cost)
+    task_id = uuid()
+    try:
+        # Held under the task's own id: before_start re-pins it and after_return releases it
+        pin_session(os.path.basename(args[task.session_arg + 1]), QUEUED_PIN_SECONDS + route['time_limit'], task_id)
+    except Exception as e:
+        logger.error(f"Error pinning session: {str(e)}")
+    logger.info(f"Dispatching {task.name} (cost {cost:.3g}) to queue {route['queue']} with priority {route['priority']}")
+    return task.apply_async(args=args, kwargs=kwargs, task_id=task_id, **route)
+
+@worker_process_init.connect
+def probe_encoders(**kwargs):
+    """Build the encoder capability registry once per worker process"""
+    try:
+        init_encoder_registry()
+    except Exception as e:
+        logger.error(f"Encoder probing failed, will retry on first task: {str(e)}")
+
+# Worker processes are reused across tasks: every task gets its own scratch
+# dir, and whatever ffmpeg groups it left behind (soft time limit, retry,
+# crash) are killed once it finishes
+@task_prerun.connect
+def start_task_scope(task_id=None, **kwargs):
+    begin_task_scope(task_id)
+
+@task_postrun.connect
+def finish_task_scope(task_id=None, **kwargs):
+    end_task_scope()
+
+def group_outputs(output_files):
+    """Group <variant>_<rendition>.mp4 outputs as [{'variant': n, 'renditions': {name: file}}]"""
+    variants = {}
+    for filename in output_files:
+        base, _ = os.path.splitext(filename)
+        number, _, rendition = base.partition('_')
+        try:
+            number = int(number)
+        except ValueError:
+            continue
+        variants.setdefault(number, {})[rendition or 'original'] = filename
+    return [{'variant': number, 'renditions': variants[number]} for number in sorted(variants)]
+
+class ProgressTask(celery.Task):
+    """Task whose state updates are also pushed to the session's SocketIO room.
+
+    Clients stop at the first FAILURE they see, so only a final failure may
+    be reported as one; errors the job recovers from are PROCESSING updates.
+    """
+
+    def update_state(self, task_id=None, state=None, meta=None, **kwargs):
+        super().update_state(task_id=task_id, state=state, meta=meta, **kwargs)
+        session_id = getattr(self.request, 'session_id', None)
+        if session_id:
+            publish_progress(session_id, task_id or self.request.id, state, meta)
+
+    # Every session task takes (session_input_dir, session_output_dir, ...) at
+    # args[session_arg]: the session is pinned against eviction (under the
+    # task's id) while it runs and re-indexed after
+    session_arg = 0
+
+    def pin_ttl(self):
+        hard_limit = (self.request.timelimit or (None,))[0]
+        return hard_limit or self.time_limit or celery.conf.task_time_limit
+
+    def before_start(self, task_id, args, kwargs):
+        try:
+            pin_session(os.path.basename(args[self.session_arg + 1]), self.pin_ttl(), task_id)
+        except Exception as e:
+            logger.error(f"Error pinning session: {str(e)}")
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        try:
+            input_dir, output_dir = args[self.session_arg:self.session_arg + 2]
+            session_id = os.path.basename(output_dir)
+            record_session(session_id, input_dir, output_dir)
+            # A task replaced by a chord keeps its pin: the chord callback
+            # runs under the same task id and releases it when the job ends
+            if status != states.IGNORED:
+                unpin_session(session_id, task_id)
+        except Exception as e:
+            logger.error(f"Error indexing session: {str(e)}")
+
 @celery.task(bind=True, 
+             base=ProgressTask,
              max_retries=3,
              default_retry_delay=5,
              autoretry_for=(Exception,),
              retry_backoff=True,
              name='video_processing.process_video_task')
-def process_video_task(self, session_input_dir, session_output_dir, copies, orientation):
+def process_video_task(self, session_input_dir, session_output_dir, copies, orientation, fanout=False,
+                       num_transforms=0, segment_seconds=0, content_hash=None, renditions=None,
+                       quality_target=0, quality_metric='ssim', seed=None, bitstream=False):
     try:
         logger.info(f"[TASK {self.request.id}] Starting video processing task")
-        logger.debug(f"Parameters: input_dir={session_input_dir}, output_dir={session_output_dir}, copies={copies}, orientation={orientation}")
+        self.request.session_id = os.path.basename(session_output_dir)
+        logger.debug(f"Parameters: input_dir={session_input_dir}, output_dir={session_output_dir}, copies={copies}, orientation={orientation}, fanout={fanout}, num_transforms={num_transforms}, segment_seconds={segment_seconds}, content_hash={content_hash}, renditions={renditions}, quality_target={quality_target}, quality_metric={quality_metric}, seed={seed}, bitstream={bitstream}")
         
         # Initial state update
         self.update_state(state='PROCESSING', meta={'status': 'Starting video processing...'})
         
-        # Ensure output directory exists and is empty
-        if os.path.exists(session_output_dir):
-            shutil.rmtree(session_output_dir)
-        os.makedirs(session_output_dir)
-        logger.info(f"[TASK {self.request.id}] Created output directory: {session_output_dir}")
+        # A retry or re-delivery resumes: outputs checkpointed by an earlier
+        # attempt are kept (and its seed reused), anything unfinished is removed
+        os.makedirs(session_output_dir, exist_ok=True)
+        kept = discard_unverified_outputs(session_output_dir)
+        if kept:
+            logger.info(f"[TASK {self.request.id}] Resuming with verified outputs: {kept}")
+            if seed is None:
+                seed = recorded_job_seed(session_output_dir)
+
+        # Independent variants are spread over the workers, one subtask each;
+        # the chord callback then finishes the job under this task's id. The
+        # source hash computed by the planner is reused by main_modified
+        items, content_hash = plan_distributed_variants(session_input_dir, session_output_dir, copies, orientation, task=self,
+                                          fanout=fanout, num_transforms=num_transforms,
+                                          segment_seconds=segment_seconds, content_hash=content_hash,
+                                          renditions=renditions, quality_target=quality_target,
+                                          quality_metric=quality_metric, seed=seed, resume=True,
+                                          bitstream=bitstream)
+        if items:
+            route = route_job(estimate_job_cost(items[0]['source']))
+            logger.info(f"[TASK {self.request.id}] Splitting into {len(items)} variant tasks on queue {route['queue']}")
+            self.update_state(state='PROCESSING', meta={'status': f'Encoding {len(items)} variants...', 'percent': 0})
+            header = [
+                encode_variant_task.s(session_input_dir, session_output_dir, item, self.request.id, i, len(items)).set(**route)
+                for i, item in enumerate(items)
+            ]
+            # The job's pin has to outlive this task: cover every variant running back to back
+            pin_session(self.request.session_id, self.pin_ttl() * (len(items) + 1), self.request.id)
+            return self.replace(chord(header, collect_variants_task.s(session_input_dir, session_output_dir)))
         
         # Process video using original logic
         logger.info(f"[TASK {self.request.id}] Calling main_modified")
-        main_modified(session_input_dir, session_output_dir, copies, orientation, task=self)
+        main_modified(session_input_dir, session_output_dir, copies, orientation, task=self, fanout=fanout,
+                      num_transforms=num_transforms, segment_seconds=segment_seconds,
+                      content_hash=content_hash, renditions=renditions,
+                      quality_target=quality_target, quality_metric=quality_metric, seed=seed, resume=True,
+                      bitstream=bitstream)
         logger.info(f"[TASK {self.request.id}] Finished main_modified")
         
         # Wait a moment to ensure all files are written
@@ -67,8 +225,7 @@ def process_video_task(self, session_input_dir, session_output_dir, copies, orie
         time.sleep(2)
         
         # Verify the output files
-        output_files = [f for f in os.listdir(session_output_dir) 
-                       if os.path.isfile(os.path.join(session_output_dir, f))]
+        output_files = list_outputs(session_output_dir)
         
         logger.info(f"[TASK {self.request.id}] Found output files: {output_files}")
         logger.debug(f"[TASK {self.request.id}] Output directory contents: {os.listdir(session_output_dir)}")
@@ -91,14 +248,22 @@ def process_video_task(self, session_input_dir, session_output_dir, copies, orie
         # Return success with the list of generated files
         result = {
             'status': 'success',
-            'files': output_files
+            'files': output_files,
+            # Seed and parameters of every output, enough to replay it
+            'recipes': load_recipe_manifest(session_output_dir)
         }
+        if renditions:
+            result['variants'] = group_outputs(output_files)
         logger.info(f"[TASK {self.request.id}] Task completed successfully with result: {result}")
         self.update_state(
             state=states.SUCCESS,
             meta=result
         )
         return result
+
+    except Ignore:
+        # Replaced by the per-variant chord
+        raise
         
     except Exception as e:
         error_msg = f"Error in process_video_task: {str(e)}"
@@ -113,4 +278,173 @@ def process_video_task(self, session_input_dir, session_output_dir, copies, orie
             }
         )
         # Let the autoretry_for handle the retry if needed
-        raise 
\ No newline at end of file
+        raise 
+
+class VariantTask(ProgressTask):
+    """One variant of a job split by process_video_task.
+
+    Its progress is folded into the job's: every update records this
+    variant's percent and publishes the average over all variants under
+    the job's task id, which is what the client follows.
+    """
+
+    def update_state(self, task_id=None, state=None, meta=None, **kwargs):
+        job = getattr(self.request, 'job', None)
+        if task_id or not job or state != 'PROCESSING':
+            # Failures are handled by the variant's fallback copy, the job is judged by the callback
+            return super().update_state(task_id=task_id, state=state, meta=meta, **kwargs)
+        job_id, part, parts = job
+        meta = meta or {}
+        try:
+            # Status-only updates keep the variant's last percent
+            percent = record_part_progress(job_id, part, meta.get('percent'), parts)
+        except Exception as e:
+            logger.error(f"Error aggregating progress: {str(e)}")
+            return
+        super().update_state(task_id=job_id, state=state, meta={
+            'status': f"Variant {part + 1}/{parts}: {meta.get('status', '')}",
+            'percent': percent,
+        }, **kwargs)
+
+@celery.task(bind=True,
+             base=VariantTask,
+             max_retries=3,
+             default_retry_delay=5,
+             autoretry_for=(Exception,),
+             retry_backoff=True,
+             name='video_processing.encode_variant_task')
+def encode_variant_task(self, session_input_dir, session_output_dir, item, job_id, part, parts):
+    """Encode one work item of a split job; returns its output name or None"""
+    logger.info(f"[TASK {self.request.id}] Variant {part + 1}/{parts} of job {job_id}: {item['output']}")
+    self.request.session_id = os.path.basename(session_output_dir)
+    self.request.job = (job_id, part, parts)
+    self.update_state(state='PROCESSING', meta={'status': 'Starting...', 'percent': 0})
+
+    written = encode_variant_item(item, session_output_dir, task=self)
+    self.update_state(state='PROCESSING', meta={'status': 'Done' if written else 'Failed', 'percent': 100})
+    return written
+
+@celery.task(bind=True,
+             base=ProgressTask,
+             session_arg=1,
+             name='video_processing.collect_variants_task')
+def collect_variants_task(self, results, session_input_dir, session_output_dir):
+    """Chord callback of a split job: returns the job's result in process_video_task's format"""
+    self.request.session_id = os.path.basename(session_output_dir)
+    written = [r for r in results if r]
+    logger.info(f"[TASK {self.request.id}] {len(written)}/{len(results)} variants written")
+    if not written:
+        error_msg = "No output files were generated"
+        self.update_state(state=states.FAILURE, meta={'status': error_msg, 'error': error_msg})
+        return {'status': 'error', 'error': error_msg}
+
+    # Every variant task checkpointed its own output into the manifest
+    result = {
+        'status': 'success',
+        'files': written,
+        'recipes': load_recipe_manifest(session_output_dir)
+    }
+    self.update_state(state=states.SUCCESS, meta=result)
+    return result
+
+@celery.task(bind=True,
+             base=ProgressTask,
+             name='video_processing.process_stream_task')
+def process_stream_task(self, session_input_dir, session_output_dir, copies, orientation, num_transforms=0):
+    """Process a faststart/fragmented upload while its chunks are still arriving.
+
+    Not retried automatically: the source is consumed as a stream and may
+    be incomplete at any point before the upload finishes.
+    """
+    try:
+        logger.info(f"[TASK {self.request.id}] Starting streaming video processing task")
+        self.request.session_id = os.path.basename(session_output_dir)
+        logger.debug(f"Parameters: input_dir={session_input_dir}, output_dir={session_output_dir}, copies={copies}, orientation={orientation}, num_transforms={num_transforms}")
+
+        self.update_state(state='PROCESSING', meta={'status': 'Waiting for upload...'})
+        os.makedirs(session_output_dir, exist_ok=True)
+
+        session_info = load_session_info(session_input_dir)
+        paths = [
+            partial_upload_path(session_input_dir, session_info),
+            os.path.join(session_input_dir, session_info['filename'])
+        ]
+
+        def feed(pipe):
+            feed_growing_file(paths, pipe,
+                              lambda: contiguous_received_bytes(session_input_dir, session_info),
+                              session_info['filesize'])
+
+        output_files = [f"{i + 1}.mp4" for i in range(copies)]
+        seed = new_seed()
+        recipes = [VariantRecipe(variant_seed(seed, i + 1), num_transforms, orientation) for i in range(copies)]
+        generate_streamed_variants(feed, [os.path.join(session_output_dir, f) for f in output_files],
+                                   orientation, task=self, num_transforms=num_transforms, recipes=recipes)
+        manifest = save_recipe_manifest(session_output_dir, {
+            f: recipe_entry(recipe, 'stream', session_info['filename'], job_seed=seed)
+            for f, recipe in zip(output_files, recipes)
+        })
+
+        result = {
+            'status': 'success',
+            'files': output_files,
+            'recipes': manifest
+        }
+        logger.info(f"[TASK {self.request.id}] Task completed successfully with result: {result}")
+        self.update_state(
+            state=states.SUCCESS,
+            meta=result
+        )
+        return result
+
+    except Exception as e:
+        error_msg = f"Error in process_stream_task: {str(e)}"
+        logger.error(f"[TASK {self.request.id}] {error_msg}")
+        logger.error(f"[TASK {self.request.id}] Traceback: {traceback.format_exc()}")
+
+        self.update_state(
+            state=states.FAILURE,
+            meta={
+                'status': error_msg,
+                'error': error_msg
+            }
+        )
+        raise
+
+@celery.task(bind=True,
+             base=ProgressTask,
+             max_retries=3,
+             default_retry_delay=5,
+             autoretry_for=(Exception,),
+             retry_backoff=True,
+             name='video_processing.replay_variant_task')
+def replay_variant_task(self, session_input_dir, session_output_dir, filename):
+    """Rebuild one output of a session from its recorded recipe"""
+    try:
+        logger.info(f"[TASK {self.request.id}] Replaying {filename} in {session_output_dir}")
+        self.request.session_id = os.path.basename(session_output_dir)
+        self.update_state(state='PROCESSING', meta={'status': f'Rebuilding {filename}...'})
+
+        replay_variant(session_output_dir, filename, session_input_dir, task=self)
+
+        result = {
+            'status': 'success',
+            'files': [filename],
+            'recipes': {filename: load_recipe_manifest(session_output_dir)[filename]}
+        }
+        self.update_state(state=states.SUCCESS, meta=result)
+        return result
+
+    except (KeyError, FileNotFoundError) as e:
+        # Nothing to replay from, retrying will not help
+        error_msg = f"Cannot replay {filename}: {str(e)}"
+        logger.error(f"[TASK {self.request.id}] {error_msg}")
+        self.update_state(state=states.FAILURE, meta={'status': error_msg, 'error': error_msg})
+        return {'status': 'error', 'error': error_msg}
+
+    except Exception as e:
+        error_msg = f"Error in replay_variant_task: {str(e)}"
+        logger.error(f"[TASK {self.request.id}] {error_msg}")
+        logger.error(f"[TASK {self.request.id}] Traceback: {traceback.format_exc()}")
+        self.update_state(state=states.FAILURE, meta={'status': error_msg, 'error': error_msg})
+        raise
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+from collections import deque
+
+try:
+    import resource
+except ImportError:  # Windows: no rlimits, process groups still work via start_new_session
+    resource = None
+
+# ffmpeg children run in their own process group under these limits, so a
+# runaway encode is killed on its own and a task can always take down
+# everything it started. 0 disables a limit. The memory limit caps the data
+# segment (heap), not the address space hardware encoders reserve; the
+# container's cgroup limit stays the hard ceiling.
+FFMPEG_MEMORY_LIMIT_MB = int(os.environ.get('FFMPEG_MEMORY_LIMIT_MB', '4096'))
+FFMPEG_CPU_SECONDS = int(os.environ.get('FFMPEG_CPU_SECONDS', '7200'))
+
+_children = set()
+_children_lock = threading.Lock()
+_scratch_dir = None
+
+def _apply_limits(pid):
+    """Set the rlimits of a just spawned child.
+
+    Done with prlimit from the parent rather than a preexec_fn, which is
+    not safe to run between fork and exec in a threaded worker.
+    """
+    if not hasattr(resource, 'prlimit'):
+        return
+    try:
+        if FFMPEG_MEMORY_LIMIT_MB:
+            limit = FFMPEG_MEMORY_LIMIT_MB * 1024 * 1024
+            resource.prlimit(pid, resource.RLIMIT_DATA, (limit, limit))
+        if FFMPEG_CPU_SECONDS:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (FFMPEG_CPU_SECONDS, FFMPEG_CPU_SECONDS))
+    except OSError as e:
+        # Already exited, or not allowed to lower another process' limits
+        print(f"[Supervisor] Could not limit process {pid}: {str(e)}")
+
+def kill_process_group(process):
+    """Kill process and everything it spawned"""
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def popen_process(cmd, **kwargs):
+    """subprocess.Popen in a new process group with rlimits, tracked until it exits"""
+    kwargs['start_new_session'] = True
+    process = subprocess.Popen(cmd, **kwargs)
+    _apply_limits(process.pid)
+    with _children_lock:
+        _children.add(process)
+    return process
+
+def release_process(process):
+    with _children_lock:
+        _children.discard(process)
+
+def run_process(cmd, check=False, capture_output=False, text=False, timeout=None, input=None):
+    """Supervised subprocess.run: the process group is killed if waiting is interrupted.
+
+    That covers timeouts as well as exceptions raised in the waiting thread,
+    such as Celery's SoftTimeLimitExceeded.
+    """
+    kwargs = {'universal_newlines': text}
+    if capture_output:
+        kwargs['stdout'] = subprocess.PIPE
+        kwargs['stderr'] = subprocess.PIPE
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    process = popen_process(cmd, **kwargs)
+    try:
+        stdout, stderr = process.communicate(input, timeout=timeout)
+    except BaseException:
+        kill_process_group(process)
+        process.wait()
+        raise
+    finally:
+        release_process(process)
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+def _is_running(process):
+    # subprocess.Popen only refreshes returncode in poll(); asyncio processes keep it current
+    if hasattr(process, 'poll'):
+        return process.poll() is None
+    return process.returncode is None
+
+class AsyncProcessRunner:
+    """Runs supervised processes from asyncio, at most `concurrency` at a time.
+
+    Every process gets a timeout (killing its group when exceeded), a ring
+    buffer with the tail of its stderr, and is killed as well when the
+    awaiting coroutine is cancelled.
+    """
+
+    def __init__(self, concurrency=None, stderr_lines=50):
+        self.semaphore = asyncio.Semaphore(concurrency or os.cpu_count() or 1)
+        self.stderr_lines = stderr_lines
+
+    async def run(self, cmd, timeout=None, on_line=None, check=True):
+        """Run cmd, passing each stdout line to on_line; returns (returncode, stderr tail)"""
+        async with self.semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
+            _apply_limits(process.pid)
+            with _children_lock:
+                _children.add(process)
+            stderr_tail = deque(maxlen=self.stderr_lines)
+
+            async def drain_stderr():
+                async for line in process.stderr:
+                    stderr_tail.append(line.decode(errors='replace'))
+
+            async def read_stdout():
+                async for line in process.stdout:
+                    if on_line:
+                        on_line(line.decode(errors='replace'))
+
+            try:
+                await asyncio.wait_for(asyncio.gather(drain_stderr(), read_stdout(), process.wait()), timeout)
+            except BaseException:
+                # Timeout or cancellation
+                kill_process_group(process)
+                await process.wait()
+                raise
+            finally:
+                release_process(process)
+
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, None, ''.join(stderr_tail))
+        return process.returncode, ''.join(stderr_tail)
+
+def kill_all_processes():
+    """Kill every supervised process group still alive; returns how many were killed"""
+    with _children_lock:
+        children = list(_children)
+        _children.clear()
+    killed = 0
+    for process in children:
+        if _is_running(process):
+            kill_process_group(process)
+            killed += 1
+    return killed
+
+def begin_task_scope(name):
+    """Give the current task its own scratch dir for everything created via tempfile"""
+    global _scratch_dir
+    end_task_scope()
+    _scratch_dir = tempfile.mkdtemp(prefix=f"task-{name}-", dir=tempfile.gettempdir())
+    tempfile.tempdir = _scratch_dir
+
+def end_task_scope():
+    """Kill leftover children and remove the task's scratch dir"""
+    global _scratch_dir
+    killed = kill_all_processes()
+    if killed:
+        print(f"[Supervisor] Killed {killed} leftover process groups")
+    if _scratch_dir:
+        tempfile.tempdir = None
+        shutil.rmtree(_scratch_dir, ignore_errors=True)
+        _scratch_dir = None
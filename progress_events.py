@@ -0,0 +1,59 @@
+import os
+import redis
+from flask_socketio import SocketIO
+
+# Workers emit task progress straight to the session's SocketIO room through
+# the Redis message queue the web tier's SocketIO server listens on
+REDIS_URL = os.environ.get('CELERY_BROKER_URL', 'redis://redis:6379/0')
+
+_redis_client = None
+_emitter = None
+
+def get_redis():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(REDIS_URL)
+    return _redis_client
+
+def get_emitter():
+    """Write-only SocketIO client for processes that are not the web server"""
+    global _emitter
+    if _emitter is None:
+        _emitter = SocketIO(message_queue=REDIS_URL)
+    return _emitter
+
+def progress_event(session_id, task_id, state, meta):
+    """Event in the same shape /task/<task_id> returns, tagged with its session and task"""
+    meta = meta or {}
+    event = {'session_id': session_id, 'task_id': task_id, 'state': state}
+    if state == 'SUCCESS':
+        event['result'] = meta
+    else:
+        event['status'] = str(meta.get('status', ''))
+        for key in ('percent', 'eta'):
+            if key in meta:
+                event[key] = meta[key]
+        if state == 'FAILURE':
+            event['error'] = str(meta.get('error', meta.get('status', 'Task failed')))
+    return event
+
+def publish_progress(session_id, task_id, state, meta):
+    try:
+        get_emitter().emit('progress', progress_event(session_id, task_id, state, meta), to=session_id)
+    except Exception as e:
+        # Progress push is best effort, the result backend still has the state
+        print(f"Error publishing progress: {str(e)}")
+
+def record_part_progress(job_id, part, percent, parts):
+    """Store the percent of one part of a split job; returns the job's overall percent.
+
+    With percent None nothing is stored and the current overall percent is returned.
+    """
+    key = f'progress:parts:{job_id}'
+    pipe = get_redis().pipeline()
+    if percent is not None:
+        pipe.hset(key, part, percent)
+        pipe.expire(key, 24 * 3600)
+    pipe.hvals(key)
+    values = pipe.execute()[-1]
+    return round(sum(float(v) for v in values) / max(1, parts), 1)
@@ -12,6 +12,17 @@ document.addEventListener('DOMContentLoaded', () => {
     const errorMessage = document.getElementById('errorMessage');
 
     let pollInterval = null;
+    let watchedSessionId = null;
+
+    // Task progress is pushed over SocketIO; polling only runs while the socket is down
+    const socket = (typeof io !== 'undefined') ? io() : null;
+    if (socket) {
+        socket.on('connect', () => {
+            if (watchedSessionId) {
+                socket.emit('join', { session_id: watchedSessionId });
+            }
+        });
+    }
     let currentFile = null; // Store the current file
 
     // Handle drag and drop
@@ -92,55 +103,111 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    function watchTask(taskId, sessionId) {
+        watchedSessionId = sessionId;
+        if (socket) {
+            socket.on('progress', (data) => {
+                if (data.task_id === taskId) {
+                    handleTaskStatus(data, sessionId);
+                }
+            });
+            if (socket.connected) {
+                socket.emit('join', { session_id: sessionId });
+            }
+        }
+
+        // One poll catches anything that happened before the room was joined
+        pollTaskStatus(taskId, sessionId);
+        pollInterval = setInterval(() => {
+            if (!socket || !socket.connected) {
+                pollTaskStatus(taskId, sessionId);
+            }
+        }, 2000);
+    }
+
+    function stopWatching() {
+        clearInterval(pollInterval);
+        watchedSessionId = null;
+        if (socket) {
+            socket.off('progress');
+        }
+    }
+
     async function pollTaskStatus(taskId, sessionId) {
         try {
             console.log(`Polling task status for task ${taskId}`);
             const response = await fetch(`/task/${taskId}`);
             const data = await response.json();
             console.log('Task status response:', data);
+            handleTaskStatus(data, sessionId);
+        } catch (error) {
+            console.error('Error polling task status:', error);
+            // Don't clear interval on network errors, keep trying
+            progressText.textContent = 'Checking status...';
+        }
+    }
 
-            // Update progress text for any state
-            if (data.status) {
-                progressText.textContent = data.status;
-                console.log('Updated progress text:', data.status);
-            }
+    function handleTaskStatus(data, sessionId) {
+        if (watchedSessionId !== sessionId) {
+            // Already finished, ignore late updates
+            return;
+        }
 
-            if (data.state === 'SUCCESS') {
-                console.log('Task succeeded:', data);
-                clearInterval(pollInterval);
-                hideProgress();
-                if (data.result && data.result.status === 'success' && data.result.files) {
-                    console.log('Showing results with files:', data.result.files);
-                    showResults({
-                        session_id: sessionId,
-                        files: data.result.files
-                    });
-                } else {
-                    console.log('Task success but no valid result:', data);
-                    showError(data.result?.error || 'Processing failed');
-                }
-                submitButton.disabled = false;
-            } else if (data.state === 'FAILURE') {
-                console.log('Task failed:', data);
-                clearInterval(pollInterval);
-                hideProgress();
-                showError(data.error || data.status || 'Processing failed');
-                submitButton.disabled = false;
-            } else if (data.state === 'PROCESSING') {
-                console.log('Task processing');
-                // Show progress bar at 90% during processing
-                progressBar.style.width = '90%';
-            } else if (data.state === 'PENDING') {
-                console.log('Task pending');
-                // Show progress bar at 10% while pending
-                progressBar.style.width = '10%';
+        // Update progress text for any state
+        if (data.status) {
+            progressText.textContent = data.status;
+            console.log('Updated progress text:', data.status);
+        }
+
+        if (data.state === 'SUCCESS') {
+            console.log('Task succeeded:', data);
+            stopWatching();
+            hideProgress();
+            if (data.result && data.result.status === 'success' && data.result.files) {
+                console.log('Showing results with files:', data.result.files);
+                showResults({
+                    session_id: sessionId,
+                    files: data.result.files
+                });
             } else {
-                console.log('Unknown task state:', data.state);
+                console.log('Task success but no valid result:', data);
+                showError(data.result?.error || 'Processing failed');
+            }
+            submitButton.disabled = false;
+        } else if (data.state === 'FAILURE') {
+            console.log('Task failed:', data);
+            stopWatching();
+            hideProgress();
+            showError(data.error || data.status || 'Processing failed');
+            submitButton.disabled = false;
+        } else if (data.state === 'PROCESSING') {
+            console.log('Task processing');
+            // Real percentage when the worker knows it, otherwise 90% during processing
+            progressBar.style.width = (typeof data.percent === 'number') ? `${data.percent}%` : '90%';
+        } else if (data.state === 'PENDING') {
+            console.log('Task pending');
+            // Show progress bar at 10% while pending
+            progressBar.style.width = '10%';
+        } else {
+            console.log('Unknown task state:', data.state);
+        }
+    }
+
+    async function resumeUploadSession(sessionId) {
+        if (!sessionId) {
+            return null;
+        }
+        try {
+            const response = await fetch(`/upload/status/${sessionId}`);
+            if (!response.ok) {
+                return null;
             }
+            const status = await response.json();
+            console.log(`Resuming upload ${sessionId}: ${status.received_chunks}/${status.total_chunks} chunks on server`);
+            return status;
         } catch (error) {
-            console.error('Error polling task status:', error);
-            // Don't clear interval on network errors, keep trying
-            progressText.textContent = 'Checking status...';
+            console.error('Error checking upload status:', error);
+            return null;
         }
     }
 
@@ -157,70 +224,111 @@ document.addEventListener('DOMContentLoaded', () => {
         showProgress();
         hideError();
 
-        const CHUNK_SIZE = 1024 * 1024; // 1MB chunks
-        const totalChunks = Math.ceil(currentFile.size / CHUNK_SIZE);
-        let uploadedChunks = 0;
+        const CHUNK_SIZE = 8 * 1024 * 1024; // 8MB chunks (server clamps to 1-16MB)
+        const MAX_CHUNK_RETRIES = 3;
 
         try {
-            // First create a session for this upload
-            const sessionResponse = await fetch('/upload/start', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    filename: currentFile.name,
-                    filesize: currentFile.size,
-                    orientation: form.orientation.value,
-                    copies: form.copies.value
-                })
-            });
-
-            if (!sessionResponse.ok) {
-                throw new Error('Failed to start upload session');
-            }
-
-            const { session_id } = await sessionResponse.json();
+            // Resume an interrupted upload of the same file if the server still has it
+            const resumeKey = `upload:${currentFile.name}:${currentFile.size}:${currentFile.lastModified}`;
+            let session = await resumeUploadSession(localStorage.getItem(resumeKey));
 
-            // Upload file in chunks
-            for (let start = 0; start < currentFile.size; start += CHUNK_SIZE) {
-                const chunk = currentFile.slice(start, start + CHUNK_SIZE);
-                const formData = new FormData();
-                formData.append('chunk', chunk);
-                formData.append('chunk_number', Math.floor(start / CHUNK_SIZE));
-                formData.append('total_chunks', totalChunks);
-
-                const response = await fetch(`/upload/chunk/${session_id}`, {
+            if (!session) {
+                // Create a new session for this upload
+                const sessionResponse = await fetch('/upload/start', {
                     method: 'POST',
-                    body: formData
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify({
+                        filename: currentFile.name,
+                        filesize: currentFile.size,
+                        chunk_size: CHUNK_SIZE,
+                        stream: form.stream.checked,
+                        orientation: form.orientation.value,
+                        copies: form.copies.value,
+                        renditions: form.renditions.value
+                    })
                 });
 
-                if (!response.ok) {
-                    throw new Error('Failed to upload chunk');
+                if (!sessionResponse.ok) {
+                    throw new Error('Failed to start upload session');
                 }
 
-                uploadedChunks++;
-                const uploadProgress = (uploadedChunks / totalChunks) * 100;
-                progressBar.style.width = `${uploadProgress}%`;
-                progressText.textContent = `Uploading: ${Math.round(uploadProgress)}%`;
+                const started = await sessionResponse.json();
+                session = {
+                    ...started,
+                    missing_chunks: Array.from({ length: started.total_chunks }, (_, i) => i)
+                };
+                localStorage.setItem(resumeKey, session.session_id);
             }
 
+            const session_id = session.session_id;
+            const chunkSize = session.chunk_size;
+            const totalChunks = Math.max(session.total_chunks, 1);
+            const queue = session.missing_chunks.slice();
+            let uploadedChunks = totalChunks - queue.length;
+
+            const uploadChunk = async (chunkNumber) => {
+                const start = chunkNumber * chunkSize;
+                const chunk = currentFile.slice(start, start + chunkSize);
+                for (let attempt = 1; ; attempt++) {
+                    const formData = new FormData();
+                    formData.append('chunk', chunk);
+                    formData.append('chunk_number', chunkNumber);
+                    formData.append('total_chunks', totalChunks);
+                    try {
+                        const response = await fetch(`/upload/chunk/${session_id}`, {
+                            method: 'POST',
+                            body: formData
+                        });
+                        if (response.ok) {
+                            return;
+                        }
+                    } catch (error) {
+                        console.error(`Chunk ${chunkNumber} attempt ${attempt} failed:`, error);
+                    }
+                    if (attempt >= MAX_CHUNK_RETRIES) {
+                        throw new Error('Failed to upload chunk');
+                    }
+                }
+            };
+
+            // Keep up to `concurrency` chunks in flight
+            const worker = async () => {
+                while (queue.length > 0) {
+                    await uploadChunk(queue.shift());
+                    uploadedChunks++;
+                    const uploadProgress = (uploadedChunks / totalChunks) * 100;
+                    progressBar.style.width = `${uploadProgress}%`;
+                    progressText.textContent = `Uploading: ${Math.round(uploadProgress)}%`;
+                }
+            };
+            const workers = Array.from({ length: Math.max(session.concurrency || 1, 1) }, worker);
+            await Promise.all(workers);
+
             // Complete the upload
             const completeResponse = await fetch(`/upload/complete/${session_id}`, {
-                method: 'POST'
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({
+                    orientation: form.orientation.value,
+                    copies: form.copies.value,
+                    renditions: form.renditions.value
+                })
             });
 
             if (!completeResponse.ok) {
                 throw new Error('Failed to complete upload');
             }
+            localStorage.removeItem(resumeKey);
 
             const data = await completeResponse.json();
             progressText.textContent = 'Processing video...';
 
-            // Start polling for task status
-            pollInterval = setInterval(() => {
-                pollTaskStatus(data.task_id, session_id);
-            }, 2000);
+            // Follow task progress
+            watchTask(data.task_id, session_id);
 
         } catch (error) {
             hideProgress();
@@ -0,0 +1,100 @@
+import os
+import shutil
+import time
+from progress_events import get_redis
+
+# Index of what every session keeps on disk (uploads/ + output/), kept in
+# Redis so eviction is a sorted-set lookup instead of a directory walk
+LRU_KEY = 'storage:sessions:lru'          # ZSET session_id -> last access time
+BYTES_KEY = 'storage:sessions:bytes'      # HASH session_id -> bytes on disk
+TOTAL_KEY = 'storage:total_bytes'
+PIN_PREFIX = 'storage:pinned:'            # SET of task ids working on the session, never evicted
+SWEEP_LOCK_KEY = 'storage:sweep_lock'
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def record_session(session_id, *dirs, last_used=None):
+    """Index the session's current size on disk and mark it as used now"""
+    nbytes = sum(dir_size(d) for d in dirs if os.path.isdir(d))
+    r = get_redis()
+    old = int(r.hget(BYTES_KEY, session_id) or 0)
+    pipe = r.pipeline()
+    pipe.hset(BYTES_KEY, session_id, nbytes)
+    pipe.incrby(TOTAL_KEY, nbytes - old)
+    pipe.zadd(LRU_KEY, {session_id: last_used or time.time()})
+    pipe.execute()
+    return nbytes
+
+def touch_session(session_id):
+    get_redis().zadd(LRU_KEY, {session_id: time.time()})
+
+def pin_session(session_id, ttl, holder):
+    """Pin the session for holder; the pin lasts until every holder unpinned or ttl ran out"""
+    key = PIN_PREFIX + session_id
+    r = get_redis()
+    r.sadd(key, holder)
+    # Never shorten the pin another holder asked for
+    if r.ttl(key) < int(ttl):
+        r.expire(key, int(ttl))
+
+def unpin_session(session_id, holder):
+    # The key disappears with its last holder
+    get_redis().srem(PIN_PREFIX + session_id, holder)
+
+def forget_session(session_id):
+    r = get_redis()
+    nbytes = int(r.hget(BYTES_KEY, session_id) or 0)
+    pipe = r.pipeline()
+    pipe.zrem(LRU_KEY, session_id)
+    pipe.hdel(BYTES_KEY, session_id)
+    pipe.decrby(TOTAL_KEY, nbytes)
+    pipe.execute()
+
+def index_unknown_sessions(roots):
+    """Add session dirs missing from the index (e.g. after a Redis flush), dated by mtime"""
+    r = get_redis()
+    for root in roots:
+        if not os.path.isdir(root):
+            continue
+        for session_id in os.listdir(root):
+            if r.zscore(LRU_KEY, session_id) is None:
+                dirs = [os.path.join(base, session_id) for base in roots]
+                mtime = max((os.path.getmtime(d) for d in dirs if os.path.exists(d)), default=None)
+                record_session(session_id, *dirs, last_used=mtime)
+
+def evict_sessions(roots, max_bytes, max_idle_seconds):
+    """Delete idle sessions, then least recently used ones until the total fits max_bytes"""
+    r = get_redis()
+    cutoff = time.time() - max_idle_seconds
+    evicted = []
+    skipped = 0
+    while True:
+        oldest = r.zrange(LRU_KEY, skipped, skipped, withscores=True)
+        if not oldest:
+            break
+        session_id, last_used = oldest[0]
+        session_id = session_id.decode()
+        if last_used >= cutoff and int(r.get(TOTAL_KEY) or 0) <= max_bytes:
+            break
+        if r.exists(PIN_PREFIX + session_id):
+            skipped += 1
+            continue
+        for root in roots:
+            shutil.rmtree(os.path.join(root, session_id), ignore_errors=True)
+        forget_session(session_id)
+        evicted.append(session_id)
+    return evicted
+
+def sweep(roots, max_bytes, max_idle_seconds, interval):
+    """Run eviction if no other web process did within interval; None if skipped"""
+    if not get_redis().set(SWEEP_LOCK_KEY, 1, nx=True, ex=max(1, int(interval))):
+        return None
+    return evict_sessions(roots, max_bytes, max_idle_seconds)
@@ -0,0 +1,59 @@
+import os
+import json
+
+# On-disk state of a chunked upload session, shared by the web tier and the workers
+
+def session_info_path(session_input_dir):
+    return os.path.join(session_input_dir, 'session_info.json')
+
+def load_session_info(session_input_dir):
+    with open(session_info_path(session_input_dir), 'r') as f:
+        return json.load(f)
+
+def save_session_info(session_input_dir, session_info):
+    # Written via temp name + rename so concurrent readers never see a partial file
+    path = session_info_path(session_input_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(session_info, f)
+    os.replace(tmp_path, path)
+
+def partial_upload_path(session_input_dir, session_info):
+    return os.path.join(session_input_dir, session_info['filename'] + '.part')
+
+def received_map_path(session_input_dir):
+    return os.path.join(session_input_dir, 'received_chunks.bin')
+
+def create_received_map(session_input_dir, total_chunks):
+    with open(received_map_path(session_input_dir), 'wb') as f:
+        f.write(bytes(total_chunks))
+
+def mark_chunk_received(session_input_dir, chunk_number):
+    """Flag chunk_number in the session's received-chunk map.
+
+    The map keeps one byte per chunk rather than one bit, so concurrent
+    chunk requests in different workers never read-modify-write the same
+    byte.
+    """
+    fd = os.open(received_map_path(session_input_dir), os.O_WRONLY)
+    try:
+        os.pwrite(fd, b'\x01', chunk_number)
+    finally:
+        os.close(fd)
+
+def read_received_map(session_input_dir, total_chunks):
+    with open(received_map_path(session_input_dir), 'rb') as f:
+        return f.read(total_chunks)
+
+def missing_chunks(session_input_dir, total_chunks):
+    received = read_received_map(session_input_dir, total_chunks)
+    return [i for i in range(total_chunks) if i >= len(received) or not received[i]]
+
+def contiguous_received_bytes(session_input_dir, session_info):
+    """Length of the prefix of the upload whose chunks have all arrived"""
+    total_chunks = session_info['total_chunks']
+    received = read_received_map(session_input_dir, total_chunks)
+    prefix = 0
+    while prefix < len(received) and received[prefix]:
+        prefix += 1
+    return min(prefix * session_info['chunk_size'], session_info['filesize'])
@@ -1,187 +1,509 @@
 import os
+import asyncio
 import subprocess
 import random
 import math
 import json
+import hashlib
 import tempfile
 import time
-import sys
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import fcntl
+except ImportError:  # Windows: manifest updates are not locked across processes
+    fcntl = None
+from process_supervisor import (run_process, popen_process, release_process, kill_process_group,
+                                AsyncProcessRunner)
 
 # Функции для работы с видеофайлами
 
-def get_video_dimensions(filepath):
+def _parse_rate(rate):
+    try:
+        num, den = rate.split('/')
+        return float(num) / float(den) if float(den) else 0.0
+    except (AttributeError, ValueError):
+        return 0.0
+
+def _parse_float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+class MediaInfo:
+    """Result of a single ffprobe -show_streams -show_format run"""
+
+    __slots__ = ('path', 'streams', 'format', 'width', 'height', 'video_codec', 'audio_codec',
+                 'has_audio', 'duration', 'fps', 'bit_rate', 'size', '_keyframes')
+
+    def __init__(self, path, probe):
+        self.path = path
+        self.streams = probe.get('streams', [])
+        self.format = probe.get('format', {})
+        video = next((s for s in self.streams if s.get('codec_type') == 'video'), None)
+        audio = next((s for s in self.streams if s.get('codec_type') == 'audio'), None)
+        if video is None:
+            raise RuntimeError(f"No video stream in {path}")
+        self.width = int(video['width'])
+        self.height = int(video['height'])
+        self.video_codec = video.get('codec_name')
+        self.audio_codec = audio.get('codec_name') if audio else None
+        self.has_audio = audio is not None
+        self.duration = _parse_float(video.get('duration')) or _parse_float(self.format.get('duration'))
+        self.fps = _parse_rate(video.get('avg_frame_rate')) or _parse_rate(video.get('r_frame_rate'))
+        self.bit_rate = int(_parse_float(self.format.get('bit_rate')))
+        self.size = int(_parse_float(self.format.get('size')))
+        self._keyframes = None
+
+    @property
+    def total_frames(self):
+        return int(self.fps * self.duration)
+
+    @property
+    def keyframes(self):
+        """Presentation times of the video keyframes, read from packet flags on first use"""
+        if self._keyframes is None:
+            cmd = [
+                "ffprobe", "-v", "error",
+                "-select_streams", "v:0",
+                "-show_entries", "packet=pts_time,flags",
+                "-of", "csv=p=0",
+                self.path
+            ]
+            result = run_process(cmd, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise RuntimeError(f"ffprobe error on {self.path}\n{result.stderr}")
+            keyframes = []
+            for line in result.stdout.splitlines():
+                parts = line.split(',')
+                if len(parts) >= 2 and 'K' in parts[1] and parts[0] not in ('', 'N/A'):
+                    keyframes.append(float(parts[0]))
+            self._keyframes = sorted(keyframes)
+        return self._keyframes
+
+MEDIA_INFO_CACHE_SIZE = 64
+_media_info_cache = OrderedDict()
+_media_info_lock = threading.Lock()
+
+def probe_media(filepath):
+    """Probe filepath once and memoize the MediaInfo by path, mtime and size (LRU)"""
+    st = os.stat(filepath)
+    key = (os.path.abspath(filepath), st.st_mtime_ns, st.st_size)
+    with _media_info_lock:
+        info = _media_info_cache.get(key)
+        if info is not None:
+            _media_info_cache.move_to_end(key)
+            return info
+
     cmd = [
         "ffprobe", "-v", "error",
-        "-select_streams", "v:0",
-        "-show_entries", "stream=width,height",
+        "-show_streams", "-show_format",
         "-of", "json",
         filepath
     ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    result = run_process(cmd, capture_output=True, text=True)
     if result.returncode != 0:
         raise RuntimeError(f"ffprobe error on {filepath}\n{result.stderr}")
-    info = json.loads(result.stdout)
-    w = info["streams"][0]["width"]
-    h = info["streams"][0]["height"]
-    return w, h
+    info = MediaInfo(filepath, json.loads(result.stdout))
 
-def remove_all_metadata(input_video, output_video):
-    cmd = [
-        "ffmpeg", "-y", "-nostdin",
-        "-i", input_video,
-        "-map_metadata", "-1",
-        "-c", "copy",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    with _media_info_lock:
+        _media_info_cache[key] = info
+        _media_info_cache.move_to_end(key)
+        while len(_media_info_cache) > MEDIA_INFO_CACHE_SIZE:
+            _media_info_cache.popitem(last=False)
+    return info
 
-# Неразрушающие преобразования
-def container_rewrap(input_video, output_video):
-    exts = [".mp4", ".mkv"]
-    chosen = random.choice(exts)
-    base, _ = os.path.splitext(output_video)
-    new_out = base + chosen
-    cmd = [
-        "ffmpeg", "-y", "-nostdin",
-        "-i", input_video,
-        "-c:v", "copy",
-        "-c:a", "copy",
-        new_out
-    ]
-    subprocess.run(cmd, check=True)
+def get_video_dimensions(filepath):
+    info = probe_media(filepath)
+    return info.width, info.height
 
-def add_silent_subtitle(input_video, output_video):
+ASSUMED_INPUT_BITRATE = 4000000  # bits/s, to guess the duration of inputs that cannot be probed
+BITSTREAM_COST_FACTOR = 0.05  # Bitstream-mode remux relative to encoding the same outputs
+
+def estimate_job_cost(filepath, copies=1, renditions=None, filesize=None, bitstream=False):
+    """Rough encode cost in pixel-seconds: duration x resolution x number of outputs"""
+    outputs = max(1, copies) * max(1, len(renditions or []))
+    if bitstream and not renditions:
+        outputs *= BITSTREAM_COST_FACTOR
     try:
-        get_video_dimensions(input_video)
-    except:
-        cmd = [
-            "ffmpeg", "-y", "-nostdin",
-            "-i", input_video,
-            "-c", "copy",
-            output_video
-        ]
-        subprocess.run(cmd, check=True)
-        return
+        info = probe_media(filepath)
+        if info.duration > 0 and info.width and info.height:
+            return info.duration * info.width * info.height * outputs
+    except Exception as e:
+        print(f"Error probing {filepath} for cost estimate: {str(e)}")
+    if filesize is None:
+        filesize = os.path.getsize(filepath)
+    return filesize * 8 / ASSUMED_INPUT_BITRATE * 1280 * 720 * outputs
 
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.srt', delete=False, encoding='utf-8') as f:
-        srt_content = (
-            "1\n"
-            "00:00:00,000 --> 00:00:01,000\n\n"
-        )
-        f.write(srt_content)
-        dummy_srt = f.name
+def remove_all_metadata(input_video, output_video):
+    apply_container_stage(input_video, output_video, strip_metadata=True)
 
-    try:
-        cmd = [
-            "ffmpeg", "-y", "-nostdin",
-            "-i", input_video,
-            "-i", dummy_srt,
-            "-c:v", "copy",
-            "-c:a", "copy",
-            "-c:s", "mov_text",
-            "-map", "0",
-            "-map", "1",
-            "-f", "mp4",
-            output_video
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            cmd = [
-                "ffmpeg", "-y", "-nostdin",
-                "-i", input_video,
-                "-c", "copy",
-                output_video
-            ]
-            subprocess.run(cmd, check=True)
-    finally:
-        if os.path.exists(dummy_srt):
-            os.remove(dummy_srt)
+# Неразрушающие преобразования
+SILENT_SUBTITLE_SRT = (
+    "1\n"
+    "00:00:00,000 --> 00:00:01,000\n\n"
+)
 
-def add_dummy_chapter(input_video, output_video):
-    try:
-        get_video_dimensions(input_video)
-    except:
-        cmd = [
-            "ffmpeg", "-y", "-nostdin",
-            "-i", input_video,
-            "-c", "copy",
-            output_video
-        ]
-        subprocess.run(cmd, check=True)
-        return
+def random_metadata_tags(rng=None):
+    rng = rng or random
+    return {
+        'title': f"UniqueID_{rng.randint(100000,999999)}",
+        'comment': f"Comment_{rng.randint(1000,9999)}",
+        'artist': f"Artist_{rng.randint(100,999)}",
+    }
 
-    start_time = random.randint(0, 30)
+def dummy_chapter_metadata(rng=None):
+    rng = rng or random
+    start_time = rng.randint(0, 30)
     end_time = start_time + 10
-    chapter_str = f"""
+    return f"""
+;FFMETADATA1
 [CHAPTER]
 TIMEBASE=1/1
 START={start_time}
 END={end_time}
-title=RandomChapter{random.randint(100,999)}
-"""
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, encoding='utf-8') as f:
-        f.write(chapter_str.strip())
-        chap_file = f.name
+title=RandomChapter{rng.randint(100,999)}
+""".strip()
+
+def apply_container_stage(input_video, output_video, strip_metadata=True, tags=None,
+                          chapter=False, subtitle=False, video_bsf=None, audio_options=None,
+                          output_options=None, rng=None):
+    """Apply every remux-only change in a single stream-copy pass.
 
+    Metadata stripping, new tags, a dummy chapter (FFMETADATA input) and a
+    silent subtitle track (SRT input) are combined into one ffmpeg mux, so
+    the file is written once instead of once per change. If the combined
+    mux fails, the chapter and subtitle are dropped and the stripping/tags
+    are retried on their own. video_bsf (a bitstream filter chain for the
+    copied video), audio_options (replacing -c:a copy) and output_options
+    ride along in the same mux.
+    """
+    temp_files = []
     try:
-        cmd = [
-            "ffmpeg", "-y", "-nostdin",
-            "-i", input_video,
-            "-i", chap_file,
-            "-map_metadata", "1",
-            "-map", "0",
-            "-c:v", "copy",
-            "-c:a", "copy",
-            "-f", "mp4",
-            output_video
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
+        inputs = ["-i", input_video]
+        maps = ["-map", "0:v:0", "-map", "0:a:0?"]
+        codecs = ["-c:v", "copy"]
+        if video_bsf:
+            codecs.extend(["-bsf:v", video_bsf])
+        codecs.extend(audio_options or ["-c:a", "copy"])
+        extras_inputs, extras_maps, extras_codecs = [], [], []
+
+        if subtitle:
+            with tempfile.NamedTemporaryFile(mode='w', suffix='.srt', delete=False, encoding='utf-8') as f:
+                f.write(SILENT_SUBTITLE_SRT)
+                temp_files.append(f.name)
+            sub_index = 1 + len(extras_inputs) // 2
+            is_mkv = output_video.lower().endswith('.mkv')
+            extras_inputs.extend(["-i", f.name])
+            extras_maps.extend(["-map", f"{sub_index}:s"])
+            extras_codecs.extend(["-c:s", "srt" if is_mkv else "mov_text"])
+
+        if chapter:
+            with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, encoding='utf-8') as f:
+                f.write(dummy_chapter_metadata(rng))
+                temp_files.append(f.name)
+            chap_index = 1 + len(extras_inputs) // 2
+            extras_inputs.extend(["-i", f.name])
+            extras_maps.extend(["-map_chapters", str(chap_index)])
+
+        meta = []
+        if strip_metadata:
+            meta.extend(["-map_metadata", "-1"])
+            if not chapter:
+                meta.extend(["-map_chapters", "-1"])
+        for key, value in (tags or {}).items():
+            meta.extend(["-metadata", f"{key}={value}"])
+
+        def mux(extra_inputs, extra_maps, extra_codecs):
+            cmd = ["ffmpeg", "-y", "-nostdin"]
+            cmd.extend(inputs + extra_inputs)
+            cmd.extend(maps + extra_maps)
+            cmd.extend(codecs + extra_codecs)
+            cmd.extend(meta)
+            cmd.extend(output_options or [])
+            cmd.append(output_video)
+            return run_process(cmd, capture_output=True, text=True)
+
+        result = mux(extras_inputs, extras_maps, extras_codecs)
+        if result.returncode != 0 and (chapter or subtitle):
+            print("[Container] chapter/subtitle mux failed, retrying without them")
+            # The source chapters must still go when stripping
+            result = mux([], ["-map_chapters", "-1"] if strip_metadata and chapter else [], [])
         if result.returncode != 0:
-            cmd = [
-                "ffmpeg", "-y", "-nostdin",
-                "-i", input_video,
-                "-c", "copy",
-                output_video
-            ]
-            subprocess.run(cmd, check=True)
+            raise RuntimeError(f"Container stage failed on {input_video}\n{result.stderr}")
     finally:
-        if os.path.exists(chap_file):
-            os.remove(chap_file)
+        for path in temp_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+def container_rewrap(input_video, output_video):
+    exts = [".mp4", ".mkv"]
+    chosen = random.choice(exts)
+    base, _ = os.path.splitext(output_video)
+    new_out = base + chosen
+    apply_container_stage(input_video, new_out, strip_metadata=False)
+
+def add_silent_subtitle(input_video, output_video):
+    apply_container_stage(input_video, output_video, strip_metadata=False, subtitle=True)
+
+def add_dummy_chapter(input_video, output_video):
+    apply_container_stage(input_video, output_video, strip_metadata=False, chapter=True)
 
 def apply_random_metadata(input_video, output_video):
-    tval = f"UniqueID_{random.randint(100000,999999)}"
-    cval = f"Comment_{random.randint(1000,9999)}"
-    aval = f"Artist_{random.randint(100,999)}"
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-c:v","copy",
-        "-c:a","copy",
-        "-metadata", f"title={tval}",
-        "-metadata", f"comment={cval}",
-        "-metadata", f"artist={aval}",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    apply_container_stage(input_video, output_video, strip_metadata=False, tags=random_metadata_tags())
 
 # Разрушающие (re-encode) преобразования
-def apply_random_noise(input_video, output_video):
-    noise_val = round(random.uniform(0.05, 0.15), 2)
-    nf = f"noise=alls={noise_val}:allf=t+u"
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-filter:v", nf,
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a","aac","-b:a","128k",
-        output_video
-    ]
+
+# Параметры кодирования для отдельных преобразований
+TRANSFORM_ENCODE_OPTIONS = [
+    "-c:v","libx264","-preset","veryfast","-profile:v","high",
+    "-crf","26",
+    "-pix_fmt","yuv420p",
+    "-c:a","aac","-b:a","128k",
+]
+
+class FilterPipeline:
+    """Collects transform filter fragments and runs them as a single encode.
+
+    Transforms add their video/audio filter fragments (and any output
+    options) to the pipeline instead of each running its own
+    decode -> filter -> encode pass; the whole recipe is then compiled into
+    one -vf/-af pair or one -filter_complex graph.
+    """
+
+    def __init__(self):
+        self.video_filters = []
+        self.audio_filters = []
+        self.output_options = []
+
+    def add_video(self, fragment):
+        if fragment:
+            self.video_filters.append(fragment)
+        return self
+
+    def add_audio(self, fragment):
+        if fragment:
+            self.audio_filters.append(fragment)
+        return self
+
+    def add_options(self, *options):
+        self.output_options.extend(options)
+        return self
+
+    def without(self, prefix):
+        """Copy of the pipeline without the video filters starting with prefix"""
+        copy = FilterPipeline()
+        copy.video_filters = [f for f in self.video_filters if not f.startswith(prefix)]
+        copy.audio_filters = list(self.audio_filters)
+        copy.output_options = list(self.output_options)
+        return copy
+
+    def video_chain(self):
+        return ','.join(self.video_filters) or 'null'
+
+    def audio_chain(self):
+        return ','.join(self.audio_filters) or 'anull'
+
+    def filter_args(self):
+        """-vf/-af arguments for a single-input, single-output encode"""
+        args = []
+        if self.video_filters:
+            args.extend(["-vf", self.video_chain()])
+        if self.audio_filters:
+            args.extend(["-af", self.audio_chain()])
+        return args
+
+    def filter_complex(self, video_in='0:v', audio_in='0:a', video_out='v', audio_out='a', with_audio=True):
+        graph = f"[{video_in}]{self.video_chain()}[{video_out}]"
+        if with_audio:
+            graph += f";[{audio_in}]{self.audio_chain()}[{audio_out}]"
+        return graph
+
+    def run(self, input_video, output_video, encode_options=None):
+        cmd = ["ffmpeg","-y","-nostdin", "-i", input_video]
+        cmd.extend(self.filter_args())
+        cmd.extend(TRANSFORM_ENCODE_OPTIONS if encode_options is None else encode_options)
+        # Options added by transforms go last so they override the defaults
+        cmd.extend(self.output_options)
+        cmd.append(output_video)
+        run_process(cmd, check=True)
+
+# Фрагменты фильтров
+def random_noise_filter(rng=None):
+    rng = rng or random
+    noise_val = round(rng.uniform(0.05, 0.15), 2)
     print(f"[Random Noise] => alls={noise_val}")
-    subprocess.run(cmd, check=True)
+    return f"noise=alls={noise_val}:allf=t+u"
+
+def resolution_filter(orientation='horizontal'):
+    if orientation == 'vertical':
+        w, h = (1080, 1920)
+    else:
+        w, h = (1920, 1080)
+    return f"scale={w}:{h}"
+
+def frame_rate_filter(rng=None):
+    rng = rng or random
+    fr = rng.choice([24,25,30,60])
+    return f"fps={fr}"
+
+def small_rotation_filter(rng=None):
+    rng = rng or random
+    angle_deg = rng.uniform(-2,2)
+    angle_rad = angle_deg*math.pi/180
+    return f"rotate={angle_rad}:fillcolor=black"
+
+def flip_filter(rng=None):
+    rng = rng or random
+    return rng.choice(["hflip","vflip"])
+
+def padding_filter(w, h, orientation='horizontal'):
+    """Pad filter up to the target frame, or None if the input is already as large"""
+    if orientation == 'vertical':
+        tw, th = (1080, 1920)
+    else:
+        tw, th = (1920, 1080)
+    if w >= tw or h >= th:
+        return None
+    return f"pad={tw}:{th}:(ow-iw)/2:(oh-ih)/2"
+
+def text_overlay_filter(rng=None, seconds=None):
+    """drawtext overlay, shown for the first `seconds` only if given"""
+    rng = rng or random
+    text_str = "Follow me and check my link in bio"
+    x = rng.randint(10,100)
+    y = rng.randint(10,100)
+    fragment = f"drawtext=text='{text_str}':x={x}:y={y}:fontcolor=white:fontsize=20:shadowcolor=black:shadowx=2:shadowy=2"
+    if seconds:
+        fragment += f":enable='lt(t,{seconds})'"
+    return fragment
+
+def pixelate_filter(rng=None):
+    rng = rng or random
+    factor = rng.choice([1.1,1.2,1.3])
+    return (
+        f"scale=iw/{factor}:ih/{factor}:flags=lanczos,"
+        f"scale=iw*{factor}:ih*{factor}:flags=neighbor"
+    )
+
+def small_color_filter(rng=None):
+    rng = rng or random
+    bval = round(rng.uniform(-0.05,0.05),3)
+    cval = round(rng.uniform(0.95,1.05),3)
+    sval = round(rng.uniform(0.95,1.05),3)
+    return f"eq=brightness={bval}:contrast={cval}:saturation={sval}"
+
+FADE_IN_SECONDS = 2
+
+def fade_in_filter():
+    return f"fade=t=in:st=0:d={FADE_IN_SECONDS}"
+
+# Keeps yuv420p happy after transforms that can produce odd dimensions
+EVEN_DIMENSIONS_FILTER = "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+
+# Преобразования, из которых собирается случайный рецепт варианта
+RECIPE_TRANSFORMS = ['noise', 'rotation', 'pixelate', 'color', 'fade_in', 'mirror']
+
+def add_transform(pipeline, name, orientation='horizontal', rng=None):
+    if name == 'noise':
+        pipeline.add_video(random_noise_filter(rng))
+    elif name == 'rotation':
+        pipeline.add_video(small_rotation_filter(rng))
+    elif name == 'pixelate':
+        pipeline.add_video(pixelate_filter(rng))
+    elif name == 'color':
+        pipeline.add_video(small_color_filter(rng))
+    elif name == 'fade_in':
+        pipeline.add_video(fade_in_filter())
+    elif name == 'flip':
+        pipeline.add_video(flip_filter(rng))
+    elif name == 'mirror':
+        pipeline.add_video("hflip")
+    elif name == 'text_overlay':
+        pipeline.add_video(text_overlay_filter(rng))
+    elif name == 'frame_rate':
+        pipeline.add_video(frame_rate_filter(rng))
+    elif name == 'resolution':
+        pipeline.add_video(resolution_filter(orientation))
+    else:
+        raise ValueError(f"Unknown transform: {name}")
+    return pipeline
+
+def new_seed():
+    return random.getrandbits(32)
+
+def variant_seed(base_seed, variant_number):
+    """Seed of one numbered variant, derived from the job's base seed"""
+    digest = hashlib.blake2b(f"{base_seed}:{variant_number}".encode(), digest_size=4).digest()
+    return int.from_bytes(digest, 'big')
+
+class VariantRecipe:
+    """Every random choice behind one variant, derived from an explicit seed.
+
+    The same seed, transform count and orientation always give the same
+    transforms and parameters. The resulting filter fragments are recorded
+    too, so a stored recipe rebuilds its variant even if the random ranges
+    change later (see replay_variant).
+    """
+
+    __slots__ = ('seed', 'orientation', 'transforms', 'speed', 'video_filters', 'audio_filters')
+
+    def __init__(self, seed=None, num_transforms=0, orientation='horizontal'):
+        self.seed = new_seed() if seed is None else seed
+        self.orientation = orientation
+        rng = random.Random(self.seed)
+        self.transforms = rng.sample(RECIPE_TRANSFORMS, min(num_transforms, len(RECIPE_TRANSFORMS)))
+        pipeline = FilterPipeline()
+        for name in self.transforms:
+            add_transform(pipeline, name, orientation, rng)
+        if 'pixelate' in self.transforms:
+            pipeline.add_video(EVEN_DIMENSIONS_FILTER)
+        self.speed = random_speed_factor(rng)
+        pipeline.add_video(f"setpts=PTS/{self.speed}").add_audio(f"atempo={self.speed}")
+        self.video_filters = pipeline.video_filters
+        self.audio_filters = pipeline.audio_filters
+
+    @property
+    def num_transforms(self):
+        return len(self.transforms)
+
+    def apply(self, pipeline):
+        pipeline.video_filters.extend(self.video_filters)
+        pipeline.audio_filters.extend(self.audio_filters)
+        return pipeline
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        recipe = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(recipe, name, data[name])
+        return recipe
+
+    def fingerprint(self):
+        """Short stable hash of the recipe, for cache keys"""
+        blob = json.dumps(self.to_dict(), sort_keys=True).encode()
+        return hashlib.blake2b(blob, digest_size=8).hexdigest()
+
+def build_variant_pipeline(num_transforms=0, pipeline=None, orientation='horizontal', recipe=None):
+    """num_transforms transforms plus the speed change, as one pipeline.
+
+    Uses recipe if given, otherwise draws a new one.
+    """
+    if pipeline is None:
+        pipeline = FilterPipeline()
+    if recipe is None:
+        recipe = VariantRecipe(num_transforms=num_transforms, orientation=orientation)
+    recipe.apply(pipeline)
+    print(f"[Recipe] seed={recipe.seed} => {recipe.transforms + [f'speed={recipe.speed}']}")
+    return pipeline
+
+def apply_random_noise(input_video, output_video):
+    FilterPipeline().add_video(random_noise_filter()).run(input_video, output_video)
 
 def apply_small_speed_change(input_video, output_video):
     sp = round(random.uniform(0.95, 1.05), 3)
@@ -207,207 +529,63 @@ def apply_small_speed_change(input_video, output_video):
         output_video
     ]
     print(f"[Small Speed Change] => {sp}")
-    subprocess.run(cmd, check=True)
+    run_process(cmd, check=True)
 
 def apply_resolution_change(input_video, output_video, orientation='horizontal'):
-    if orientation == 'vertical':
-        w, h = (1080, 1920)
-    else:
-        w, h = (1920, 1080)
-
-    vf_str = f"scale={w}:{h}"
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-vf", vf_str,
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a","aac","-b:a","128k",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    FilterPipeline().add_video(resolution_filter(orientation)).run(input_video, output_video)
 
 def apply_frame_rate_change(input_video, output_video):
-    fr = random.choice([24,25,30,60])
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-r", str(fr),
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a","aac","-b:a","128k",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    FilterPipeline().add_video(frame_rate_filter()).run(input_video, output_video)
 
 def apply_audio_codec_change(input_video, output_video):
     ac = random.choice(["aac","libmp3lame"])
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a", ac,
-        "-b:a","128k","-ac","2","-ar","44100",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    pipeline = FilterPipeline().add_options("-c:a", ac, "-ac","2","-ar","44100")
+    pipeline.run(input_video, output_video)
 
 def apply_audio_sample_rate_change(input_video, output_video):
     sr = random.choice([44100,48000])
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a","aac","-ar", str(sr),
-        "-b:a","128k","-ac","2",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    pipeline = FilterPipeline().add_options("-ar", str(sr), "-ac","2")
+    pipeline.run(input_video, output_video)
 
 def apply_small_rotation(input_video, output_video):
-    angle_deg = random.uniform(-2,2)
-    angle_rad = angle_deg*math.pi/180
-    vf = f"rotate={angle_rad}:fillcolor=black"
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-vf", vf,
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a","aac","-b:a","128k",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    FilterPipeline().add_video(small_rotation_filter()).run(input_video, output_video)
 
 def apply_flip(input_video, output_video):
-    flip_type = random.choice(["hflip","vflip"])
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-vf", flip_type,
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a","aac","-b:a","128k",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    FilterPipeline().add_video(flip_filter()).run(input_video, output_video)
 
 def apply_mirror(input_video, output_video):
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-vf","hflip",
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a","aac","-b:a","128k",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    FilterPipeline().add_video("hflip").run(input_video, output_video)
 
 def apply_padding(input_video, output_video, orientation='horizontal'):
-    if orientation == 'vertical':
-        tw, th = (1080, 1920)
-    else:
-        tw, th = (1920, 1080)
-
     w,h = get_video_dimensions(input_video)
-    if w >= tw or h >= th:
+    pad = padding_filter(w, h, orientation)
+    if pad is None:
         cmd = [
             "ffmpeg","-y","-nostdin",
             "-i", input_video,
             "-c:v","copy","-c:a","copy",
             output_video
         ]
-        subprocess.run(cmd, check=True)
+        run_process(cmd, check=True)
         return
 
-    vf_str = f"pad={tw}:{th}:(ow-iw)/2:(oh-ih)/2"
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-vf", vf_str,
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a","aac","-b:a","128k",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    FilterPipeline().add_video(pad).run(input_video, output_video)
 
-def apply_text_overlay(input_video, output_video):
-    text_str = "Follow me and check my link in bio"
-    x = random.randint(10,100)
-    y = random.randint(10,100)
-    draw = f"drawtext=text='{text_str}':x={x}:y={y}:fontcolor=white:fontsize=20:shadowcolor=black:shadowx=2:shadowy=2"
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-vf", draw,
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a","aac","-b:a","128k",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+def apply_text_overlay(input_video, output_video, seconds=None):
+    if seconds:
+        # A short overlay only touches the GOPs it is shown in
+        render_range(input_video, output_video, text_overlay_filter(seconds=seconds), 0, seconds)
+        return
+    FilterPipeline().add_video(text_overlay_filter()).run(input_video, output_video)
 
 def apply_pixelate(input_video, output_video):
-    factor = random.choice([1.1,1.2,1.3])
-    pf = (
-        f"scale=iw/{factor}:ih/{factor}:flags=lanczos,"
-        f"scale=iw*{factor}:ih*{factor}:flags=neighbor"
-    )
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-vf", pf,
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a","aac","-b:a","128k",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    FilterPipeline().add_video(pixelate_filter()).run(input_video, output_video)
 
 def apply_small_color_filter(input_video, output_video):
-    bval = round(random.uniform(-0.05,0.05),3)
-    cval = round(random.uniform(0.95,1.05),3)
-    sval = round(random.uniform(0.95,1.05),3)
-    eq_str = f"eq=brightness={bval}:contrast={cval}:saturation={sval}"
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-vf", eq_str,
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a","aac","-b:a","128k",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    FilterPipeline().add_video(small_color_filter()).run(input_video, output_video)
 
 def apply_fade_in_50frames(input_video, output_video):
-    fade_filter = "fade=t=in:st=0:d=2"
-    cmd = [
-        "ffmpeg","-y","-nostdin",
-        "-i", input_video,
-        "-vf", fade_filter,
-        "-c:v","libx264","-preset","veryfast","-profile:v","high",
-        "-crf","26",
-        "-pix_fmt","yuv420p",
-        "-c:a","aac","-b:a","128k",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+    render_range(input_video, output_video, fade_in_filter(), 0, FADE_IN_SECONDS)
 
 def check_and_fix_even(input_video, output_video):
     w,h = get_video_dimensions(input_video)
@@ -419,7 +597,7 @@ def check_and_fix_even(input_video, output_video):
             "-c","copy",
             output_video
         ]
-        subprocess.run(cmd, check=True)
+        run_process(cmd, check=True)
     else:
         print(f"[CheckEven] => исправляем {w}x{h}")
         scale_str = "scale='2*ceil(iw/2)':'2*ceil(ih/2)':force_original_aspect_ratio=decrease"
@@ -433,77 +611,459 @@ def check_and_fix_even(input_video, output_video):
             "-c:a","aac","-b:a","256k",
             output_video
         ]
-        subprocess.run(cmd, check=True)
+        run_process(cmd, check=True)
 
-def compress_video(input_video, output_video, task=None):
-    """Compress video to reduce size before processing"""
-    if task:
-        task.update_state(state='PROCESSING', meta={'status': 'Compressing video...'})
-    
-    cmd = [
-        "ffmpeg", "-y", "-nostdin",
-        "-i", input_video,
-        "-c:v", "libx264",
-        "-preset", "ultrafast",
-        "-crf", "35",
-        "-vf", "scale=min(1280\\,iw):min(720\\,ih):force_original_aspect_ratio=decrease",
-        "-c:a", "aac",
-        "-b:a", "96k",
-        "-ac", "2",
-        "-movflags", "+faststart",
-        output_video
-    ]
-    subprocess.run(cmd, check=True)
+# Smart render: a filter limited to a time range re-encodes only the GOPs
+# that overlap it, everything else is stream-copied
+SMART_RENDER_CRF = int(os.environ.get('SMART_RENDER_CRF', '20'))  # Near transparent, so re-encoded GOPs do not stand out
+# Codecs the engine can splice, with the filter that keeps their parameter sets in-band
+SMART_RENDER_BSF = {'h264': 'h264_mp4toannexb'}
+H264_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high',
+    'High 10': 'high10',
+    'High 4:2:2': 'high422',
+    'High 4:4:4 Predictive': 'high444',
+}
+
+def matching_encode_options(info):
+    """libx264 options reproducing the source's profile, level and pixel format"""
+    video = next(s for s in info.streams if s.get('codec_type') == 'video')
+    opts = ["-c:v", "libx264", "-preset", "veryfast", "-crf", str(SMART_RENDER_CRF)]
+    profile = H264_PROFILES.get(video.get('profile'))
+    if profile:
+        opts.extend(["-profile:v", profile])
+    level = video.get('level')
+    if level and level > 0:
+        opts.extend(["-level", f"{level / 10:g}"])
+    if video.get('pix_fmt'):
+        opts.extend(["-pix_fmt", video['pix_fmt']])
+    return opts
+
+def smart_render(input_video, output_video, video_filter, start, end):
+    """Apply video_filter to [start, end) seconds, re-encoding only the GOPs it overlaps.
+
+    The video track is cut at the keyframes around the range into MPEG-TS
+    pieces with -c copy (parameter sets travel in-band), the middle piece is
+    re-encoded with matching codec parameters and the pieces are joined
+    with the concat demuxer; audio, metadata and chapters are copied from
+    the input. Returns False without writing anything if the input does
+    not allow it (codec, no keyframe index, range covering the whole file)
+    so the caller can encode the whole file instead.
+    """
+    info = probe_media(input_video)
+    bsf = SMART_RENDER_BSF.get(info.video_codec)
+    # Packet times include the container's start offset; ffmpeg's output
+    # timeline, the segment cut times and start/end all begin at zero
+    offset = _parse_float(info.format.get('start_time'))
+    keyframes = [k - offset for k in info.keyframes]
+    if bsf is None or not keyframes:
+        return False
+    first = max((k for k in keyframes if k <= start), default=keyframes[0])
+    last = min((k for k in keyframes if k >= end), default=None)
+    cuts = [t for t in (first, last) if t is not None and t > keyframes[0]]
+    if not cuts:
+        return False
+    print(f"[SmartRender] re-encoding {first:.3f}s-{last if last is not None else info.duration:.3f}s "
+          f"of {info.duration:.3f}s")
+
+    with tempfile.TemporaryDirectory() as piece_dir:
+        cmd = [
+            "ffmpeg", "-y", "-nostdin",
+            "-i", input_video,
+            "-map", "0:v:0", "-an",
+            "-c", "copy", "-bsf:v", bsf,
+            "-f", "segment", "-segment_format", "mpegts",
+            "-segment_times", ','.join(f"{t:.6f}" for t in cuts),
+            os.path.join(piece_dir, "piece_%03d.ts")
+        ]
+        run_process(cmd, check=True, capture_output=True)
+        pieces = sorted(os.path.join(piece_dir, f) for f in os.listdir(piece_dir) if f.startswith("piece_"))
+        middle = 1 if first > keyframes[0] else 0
+        if len(pieces) != len(cuts) + 1:
+            raise RuntimeError(f"Expected {len(cuts) + 1} pieces, got {len(pieces)}")
+        # A piece cut anywhere but at the planned keyframe would shift the splice
+        bounds = [keyframes[0]] + cuts
+        tolerance = max(0.1, 1 / info.fps) if info.fps else 0.1
+        for i, piece in enumerate(pieces[:-1]):
+            expected = bounds[i + 1] - bounds[i]
+            actual = get_media_duration(piece)
+            if abs(actual - expected) > tolerance:
+                raise RuntimeError(f"Piece {i} is {actual:.3f}s, expected {expected:.3f}s")
+
+        # Each piece starts at zero: shift it back so the filter sees source time
+        rendered = os.path.join(piece_dir, "rendered.ts")
+        cmd = [
+            "ffmpeg", "-y", "-nostdin",
+            "-i", pieces[middle],
+            "-vf", f"setpts=PTS+{first:.6f}/TB,{video_filter}",
+            "-fps_mode", "passthrough",
+        ]
+        cmd.extend(matching_encode_options(info))
+        cmd.extend(["-f", "mpegts", rendered])
+        run_process(cmd, check=True, capture_output=True)
+        pieces[middle] = rendered
 
-def generate_unique_video(input_video, output_video, orientation='horizontal', task=None):
+        # Durations are known from the cut points, so the splice does not rely on per-piece estimates
+        list_file = os.path.join(piece_dir, "concat.txt")
+        with open(list_file, 'w', encoding='utf-8') as f:
+            for i, piece in enumerate(pieces):
+                f.write(f"file '{os.path.abspath(piece)}'\n")
+                if i + 1 < len(pieces):
+                    f.write(f"duration {bounds[i + 1] - bounds[i]:.6f}\n")
+        cmd = [
+            "ffmpeg", "-y", "-nostdin",
+            "-f", "concat", "-safe", "0", "-i", list_file,
+            "-i", input_video,
+            "-map", "0:v", "-map", "1:a?",
+            "-map_metadata", "1", "-map_chapters", "1",
+            "-c", "copy", "-movflags", "+faststart",
+            output_video
+        ]
+        run_process(cmd, check=True, capture_output=True)
+    return True
+
+def render_range(input_video, output_video, video_filter, start, end):
+    """smart_render, falling back to a full encode through video_filter"""
     try:
-        if task:
-            task.update_state(state='PROCESSING', meta={'status': 'Analyzing input video...'})
-        
-        # Get input file size
-        input_size = os.path.getsize(input_video)
-        if input_size > 100 * 1024 * 1024:  # If larger than 100MB
-            if task:
-                task.update_state(state='PROCESSING', meta={'status': 'Input file too large, compressing...'})
-            
-            # Create temporary file for compressed video
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as tmp:
-                compressed_input = tmp.name
-            
-            # Compress the input video first
-            compress_video(input_video, compressed_input, task)
-            input_video = compressed_input
-
-        # Detect platform and available hardware encoders
-        platform = sys.platform
-        hw_encoders = {
-            'darwin': 'h264_videotoolbox',  # macOS
-            'linux': 'h264_nvenc',          # Linux with NVIDIA GPU
-            'win32': 'h264_nvenc'           # Windows with NVIDIA GPU
-        }
-        
-        # Default to libx264 if no hardware encoder available
-        video_encoder = hw_encoders.get(platform, 'libx264')
-        
-        # Check if NVIDIA GPU is available on Linux/Windows
-        if platform in ['linux', 'win32']:
+        if smart_render(input_video, output_video, video_filter, start, end):
+            return
+    except Exception as e:
+        print(f"[SmartRender] failed, re-encoding the whole file: {str(e)}")
+    FilterPipeline().add_video(video_filter).run(input_video, output_video)
+
+# Seconds a single ffmpeg listing or test encode may take while probing: a
+# hung driver must not stall worker startup
+ENCODER_PROBE_TIMEOUT = float(os.environ.get('ENCODER_PROBE_TIMEOUT', '10'))
+# Candidate H.264 encoders in order of preference; libx264 is the CPU fallback
+ENCODER_CANDIDATES = ['h264_nvenc', 'h264_qsv', 'h264_vaapi', 'h264_videotoolbox', 'libx264']
+# hwaccel that has to be listed by `ffmpeg -hwaccels` before a hardware encoder is probed
+ENCODER_HWACCELS = {
+    'h264_nvenc': 'cuda',
+    'h264_qsv': 'qsv',
+    'h264_vaapi': 'vaapi',
+    'h264_videotoolbox': 'videotoolbox',
+}
+VAAPI_DEVICE = os.environ.get('VAAPI_DEVICE', '/dev/dri/renderD128')
+DEFAULT_QUALITY = 35  # On the x264 CRF scale, mapped to each encoder's own rate control
+
+_encoder_registry = None
+_encoder_registry_lock = threading.Lock()
+
+def _ffmpeg_names(flag):
+    """Names listed by `ffmpeg -encoders` (video encoders only) or `ffmpeg -hwaccels`"""
+    try:
+        result = run_process(["ffmpeg", "-hide_banner", flag],
+                             capture_output=True, text=True, timeout=ENCODER_PROBE_TIMEOUT)
+    except (OSError, subprocess.SubprocessError):
+        return set()
+    names = set()
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if flag == "-encoders":
+            # " V....D libx264  libx264 H.264 / AVC ..." -> capability flags, then the name
+            if len(parts) >= 2 and len(parts[0]) == 6 and parts[0].startswith('V') and parts[1] != '=':
+                names.add(parts[1])
+        elif len(parts) == 1:
+            names.add(parts[0])
+    return names
+
+def encoder_input_args(video_encoder):
+    """Options the encoder needs ahead of -i"""
+    if video_encoder == 'h264_vaapi':
+        return ["-vaapi_device", VAAPI_DEVICE]
+    return []
+
+def encoder_upload_filter(video_encoder):
+    """Trailing video filter that moves frames to where the encoder reads them"""
+    if video_encoder == 'h264_vaapi':
+        return "format=nv12,hwupload"
+    return None
+
+def encoder_rate_control(video_encoder, quality=DEFAULT_QUALITY):
+    """Map the quality knob onto the encoder's native preset and rate-control flags"""
+    if video_encoder == 'h264_nvenc':
+        # NVENC ignores -crf; constant-quality VBR is its equivalent
+        return ["-preset", "p1", "-tune", "ll", "-profile:v", "high",
+                "-rc", "vbr", "-cq", str(quality), "-b:v", "0"]
+    if video_encoder == 'h264_qsv':
+        return ["-preset", "veryfast", "-profile:v", "high", "-global_quality", str(quality)]
+    if video_encoder == 'h264_vaapi':
+        return ["-profile:v", "high", "-qp", str(quality)]
+    if video_encoder == 'h264_videotoolbox':
+        # No constant-quality mode on every Mac: use a bitrate that halves every +6 of quality
+        bitrate = int(2000 * 2 ** ((DEFAULT_QUALITY - quality) / 6))
+        return ["-realtime", "1", "-profile:v", "high", "-b:v", f"{bitrate}k"]
+    return ["-preset", "ultrafast", "-tune", "zerolatency", "-profile:v", "high",
+            "-level", "4.1", "-crf", str(quality)]
+
+def encoder_pix_fmt(video_encoder):
+    # VAAPI gets hardware surfaces from hwupload, QSV wants NV12
+    return {'h264_vaapi': None, 'h264_qsv': 'nv12'}.get(video_encoder, 'yuv420p')
+
+def probe_encoder(video_encoder):
+    """Test-encode a tiny synthetic clip to check the encoder really works on this host"""
+    cmd = ["ffmpeg", "-hide_banner", "-nostdin", "-v", "error"]
+    cmd.extend(encoder_input_args(video_encoder))
+    cmd.extend(["-f", "lavfi", "-i", "testsrc2=size=256x144:rate=30:duration=0.5"])
+    upload = encoder_upload_filter(video_encoder)
+    if upload:
+        cmd.extend(["-vf", upload])
+    cmd.extend(["-c:v", video_encoder])
+    cmd.extend(encoder_rate_control(video_encoder))
+    pix_fmt = encoder_pix_fmt(video_encoder)
+    if pix_fmt:
+        cmd.extend(["-pix_fmt", pix_fmt])
+    cmd.extend(["-f", "null", "-"])
+    try:
+        return run_process(cmd, capture_output=True, timeout=ENCODER_PROBE_TIMEOUT).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+def init_encoder_registry(force=False):
+    """Find the encoders that work on this host, once per process.
+
+    Called from the Celery worker_process_init signal so tasks never pay
+    for the probing; anything else gets it lazily on first use.
+    """
+    global _encoder_registry
+    with _encoder_registry_lock:
+        if _encoder_registry is not None and not force:
+            return _encoder_registry
+        listed = _ffmpeg_names("-encoders")
+        hwaccels = _ffmpeg_names("-hwaccels")
+        working = []
+        for encoder in ENCODER_CANDIDATES:
+            hwaccel = ENCODER_HWACCELS.get(encoder)
+            if encoder not in listed or (hwaccel and hwaccel not in hwaccels):
+                continue
+            if probe_encoder(encoder):
+                working.append(encoder)
+        if 'libx264' not in working:
+            # Nothing usable was found; keep libx264 so encodes report the real error
+            working.append('libx264')
+        _encoder_registry = {'encoders': working, 'hwaccels': sorted(hwaccels)}
+        print(f"[Encoders] working: {', '.join(working)}; hwaccels: {', '.join(sorted(hwaccels)) or 'none'}")
+        return _encoder_registry
+
+def detect_video_encoder():
+    """Preferred working H.264 encoder from the registry"""
+    return init_encoder_registry()['encoders'][0]
+
+def video_encoder_options(video_encoder, quality=DEFAULT_QUALITY):
+    """Encoder-specific options followed by the common output parameters"""
+    opts = ["-c:v", video_encoder]
+    opts.extend(encoder_rate_control(video_encoder, quality))
+    pix_fmt = encoder_pix_fmt(video_encoder)
+    if pix_fmt:
+        opts.extend(["-pix_fmt", pix_fmt])
+
+    # Common parameters
+    opts.extend([
+        "-maxrate", "2000k",
+        "-bufsize", "4000k",
+        "-c:a", "aac",
+        "-b:a", "96k",
+        "-ac", "2",
+        "-ar", "44100",
+        "-movflags", "+faststart",
+        "-threads", "0",
+        "-g", "60",
+        "-vsync", "1",
+        "-async", "1",
+    ])
+    return opts
+
+# Caps output at 1280x720; a no-op for inputs that are already smaller
+DOWNSCALE_FILTER = "scale=min(1280\\,iw):min(720\\,ih):force_original_aspect_ratio=decrease"
+
+def downscale_filter(w, h):
+    """Scale filter capping output at 1280x720, or None if not needed"""
+    if w > 1280 or h > 720:
+        return DOWNSCALE_FILTER
+    return None
+
+def random_speed_factor(rng=None):
+    return round((rng or random).uniform(0.95, 1.05), 3)
+
+PROGRESS_UPDATES_PER_SECOND = float(os.environ.get('PROGRESS_UPDATES_PER_SECOND', '2'))
+
+class ProgressReporter:
+    """Coalesces PROCESSING state updates to at most `rate` backend writes per second"""
+
+    def __init__(self, task, rate=PROGRESS_UPDATES_PER_SECOND):
+        self.task = task
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.last_update = 0.0
+        self.pending = None
+
+    def update(self, meta, force=False):
+        if not self.task:
+            return
+        now = time.monotonic()
+        if force or now - self.last_update >= self.interval:
+            self.task.update_state(state='PROCESSING', meta=meta)
+            self.last_update = now
+            self.pending = None
+        else:
+            self.pending = meta
+
+    def flush(self):
+        if self.pending is not None:
+            self.update(self.pending, force=True)
+
+def read_ffmpeg_progress(stream):
+    """Yield the key=value blocks ffmpeg writes with -progress, one dict per report"""
+    block = {}
+    for line in stream:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        block[key] = value
+        if key == 'progress':
+            yield block
+            block = {}
+
+def progress_meta(block, duration, started):
+    """Task meta (status, percent, ETA) for one ffmpeg progress block"""
+    frame = int(_parse_float(block.get('frame')))
+    fps = _parse_float(block.get('fps'))
+    out_time = _parse_float(block.get('out_time_us')) / 1_000_000
+    meta = {'status': f'Processing: {frame} frames @ {fps:.1f} fps'}
+    if duration > 0 and out_time > 0:
+        percent = min(out_time / duration * 100, 100.0)
+        elapsed = time.monotonic() - started
+        eta = elapsed * (100 - percent) / percent
+        meta.update({
+            'status': f'Processing: {percent:.1f}% @ {fps:.1f} fps, ETA {int(eta)}s',
+            'percent': round(percent, 1),
+            'eta': int(eta),
+        })
+    return meta
+
+def with_progress_output(cmd):
+    """cmd with ffmpeg's -progress report on stdout instead of the stderr stats line"""
+    return [cmd[0], "-progress", "pipe:1", "-nostats"] + cmd[1:]
+
+def run_ffmpeg_with_progress(cmd, duration=0, task=None, progress_timeout=300, stdin_feeder=None):
+    """Run ffmpeg, reporting progress to the task until it exits.
+
+    Progress comes from ffmpeg's machine-readable -progress output on
+    stdout; percent and ETA are computed against duration (seconds of
+    output, 0 if unknown) and backend writes are throttled by
+    ProgressReporter. stderr is drained in a thread into a ring buffer so
+    neither pipe can fill up and block ffmpeg. stdin_feeder, if given, is
+    called in a thread with ffmpeg's binary stdin.
+    """
+    cmd = with_progress_output(cmd)
+    process = popen_process(
+        cmd,
+        stdin=subprocess.PIPE if stdin_feeder else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    if stdin_feeder:
+        threading.Thread(target=stdin_feeder, args=(process.stdin.buffer,), daemon=True).start()
+
+    stderr_tail = deque(maxlen=50)
+    stderr_thread = threading.Thread(target=stderr_tail.extend, args=(process.stderr,), daemon=True)
+    stderr_thread.start()
+
+    started = time.monotonic()
+    last_progress_time = [started]
+    timed_out = threading.Event()
+
+    def watchdog():
+        while process.poll() is None:
+            if time.monotonic() - last_progress_time[0] > progress_timeout:
+                timed_out.set()
+                kill_process_group(process)
+                return
+            time.sleep(1)
+    threading.Thread(target=watchdog, daemon=True).start()
+
+    reporter = ProgressReporter(task)
+    try:
+        for block in read_ffmpeg_progress(process.stdout):
+            last_progress_time[0] = time.monotonic()
             try:
-                subprocess.run(['nvidia-smi'], check=True, capture_output=True)
-            except:
-                video_encoder = 'libx264'  # Fall back to CPU if no NVIDIA GPU
+                reporter.update(progress_meta(block, duration, started))
+            except Exception as e:
+                print(f"Error parsing progress: {str(e)}")
+        reporter.flush()
+        returncode = process.wait()
+    except BaseException:
+        # Soft time limit or any other interruption: take the whole ffmpeg group down
+        kill_process_group(process)
+        process.wait()
+        raise
+    finally:
+        release_process(process)
+    stderr_thread.join(timeout=5)
+    if timed_out.is_set():
+        raise RuntimeError(f"Processing timeout - no progress for {progress_timeout} seconds")
+    if returncode != 0:
+        raise RuntimeError(f"FFmpeg failed: {''.join(stderr_tail)}")
+
+def can_stream_copy(input_video, num_transforms=0):
+    """A copy cannot apply transforms, nor the downscale and rate cap large inputs need"""
+    return not num_transforms and os.path.getsize(input_video) <= LARGE_INPUT_BYTES
+
+def copy_command(input_video, output_video):
+    """Stream copy, no re-encoding"""
+    return [
+        "ffmpeg", "-y", "-nostdin",
+        "-hwaccel", "auto",
+        "-i", input_video,
+        "-c:v", "copy",
+        "-c:a", "copy",
+        "-movflags", "+faststart",
+        output_video
+    ]
+
+def variant_encode_command(input_video, output_video, info, pipeline, video_encoder, quality=DEFAULT_QUALITY):
+    """Single-pass encode of input_video through pipeline as one filter_complex graph"""
+    # Optimized FFmpeg command with hardware acceleration
+    cmd = ["ffmpeg", "-y", "-nostdin", "-hwaccel", "auto"]
+    cmd.extend(encoder_input_args(video_encoder))
+    cmd.extend([
+        "-i", input_video,
+        "-filter_complex", pipeline.filter_complex(with_audio=info.has_audio),
+        "-map", "[v]",
+    ])
+    if info.has_audio:
+        cmd.extend(["-map", "[a]"])
+    cmd.extend(video_encoder_options(video_encoder, quality))
+    cmd.extend(pipeline.output_options)
+    cmd.append(output_video)
+    return cmd
+
+def generate_unique_video(input_video, output_video, orientation='horizontal', task=None, num_transforms=0,
+                          segment_seconds=0, quality=DEFAULT_QUALITY, recipe=None):
+    """Encode one unique variant.
+
+    num_transforms random transforms from RECIPE_TRANSFORMS are compiled
+    together with the speed change into the same encode. With
+    segment_seconds set, inputs longer than two segments are encoded
+    segment-parallel (see generate_segmented_video). recipe fixes the
+    transforms and parameters, a new one is drawn otherwise. Large inputs
+    are downscaled and rate-capped by this same encode instead of a
+    separate compression pass.
+    """
+    try:
+        if task:
+            task.update_state(state='PROCESSING', meta={'status': 'Analyzing input video...'})
+
+        video_encoder = detect_video_encoder()
         
         # First, try to copy the video without re-encoding
         try:
-            cmd = [
-                "ffmpeg", "-y", "-nostdin",
-                "-hwaccel", "auto",
-                "-i", input_video,
-                "-c:v", "copy",
-                "-c:a", "copy",
-                "-movflags", "+faststart",
-                output_video
-            ]
-            subprocess.run(cmd, check=True, capture_output=True)
+            if not can_stream_copy(input_video, num_transforms):
+                raise RuntimeError("Re-encode required")
+            run_process(copy_command(input_video, output_video), check=True, capture_output=True)
             print(f"[DONE] => {output_video} (copied without re-encoding)")
             return
         except:
@@ -512,176 +1072,1210 @@ def generate_unique_video(input_video, output_video, orientation='horizontal', t
                 task.update_state(state='PROCESSING', meta={'status': 'Direct copy failed, re-encoding...'})
 
         # Get video info
-        cmd = [
-            "ffprobe", "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", "stream=width,height,duration,r_frame_rate",
-            "-of", "json",
-            input_video
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        video_info = json.loads(result.stdout)
-        w = int(video_info['streams'][0]['width'])
-        h = int(video_info['streams'][0]['height'])
-        
-        # Calculate total frames
-        try:
-            fps_parts = video_info['streams'][0]['r_frame_rate'].split('/')
-            fps = float(fps_parts[0]) / float(fps_parts[1])
-            duration = float(video_info['streams'][0]['duration'])
-            total_frames = int(fps * duration)
-        except:
-            total_frames = 0
+        info = probe_media(input_video)
+        w, h, total_frames = info.width, info.height, info.total_frames
 
         if task:
             task.update_state(state='PROCESSING', 
                             meta={'status': f'Processing {w}x{h} video using {video_encoder}, estimated {total_frames} frames...'})
 
-        # Determine if we need to scale down
-        scale_filter = ""
-        if w > 1280 or h > 720:
-            scale_filter = "scale=min(1280\\,iw):min(720\\,ih):force_original_aspect_ratio=decrease,"
+        # Build filter chain: downscale first, then the random recipe and speed change
+        pipeline = FilterPipeline().add_video(downscale_filter(w, h))
+        build_variant_pipeline(num_transforms, pipeline, orientation, recipe)
+        pipeline.add_video(encoder_upload_filter(video_encoder))
 
-        # Apply minimal transformations
-        sp = round(random.uniform(0.95, 1.05), 3)
-        
-        # Build filter chain
-        filters = []
+        if segment_seconds and get_media_duration(input_video) > 2 * segment_seconds:
+            generate_segmented_video(input_video, output_video, pipeline, video_encoder,
+                                     segment_seconds, task=task, quality=quality)
+            if not os.path.exists(output_video) or os.path.getsize(output_video) == 0:
+                raise RuntimeError("Generated file is missing or empty")
+            print(f"[DONE] => {output_video} (segment-parallel)")
+            return
+
+        cmd = variant_encode_command(input_video, output_video, info, pipeline, video_encoder, quality)
+        run_ffmpeg_with_progress(cmd, info.duration, task)
+
+        if task:
+            task.update_state(state='PROCESSING', meta={'status': 'Verifying output...'})
+
+        # Verify the output
+        if not os.path.exists(output_video) or os.path.getsize(output_video) == 0:
+            raise RuntimeError("Generated file is missing or empty")
+
+        print(f"[DONE] => {output_video}")
+
+    except Exception as e:
+        print(f"Error in generate_unique_video: {str(e)}")
+        # Not final: the caller falls back to a copy, the job is judged at the end
+        if task:
+            task.update_state(state='PROCESSING', meta={'status': f'Encoding failed: {str(e)}'})
+        raise
+
+# Bitstream mode: copies that differ at the H.264/HEVC bitstream and
+# container level, written with -c:v copy at disk speed; only the audio is
+# re-encoded
+BITSTREAM_METADATA_BSF = {'h264': 'h264_metadata', 'hevc': 'hevc_metadata'}
+SEI_NAL_TYPES = {'h264': '6', 'hevc': '39|40'}  # filter_units remove_types for (prefix/suffix) SEI
+
+def supports_bitstream_mode(info):
+    return info.video_codec in BITSTREAM_METADATA_BSF
+
+def bitstream_variant_params(seed, info):
+    """Changes for one bitstream variant, drawn from seed: the same seed and source give the same file"""
+    rng = random.Random(seed)
+    params = {
+        'aud': rng.choice(['insert', 'remove']),
+        'drop_sei': rng.random() < 0.5,
+        'extra_crop': rng.choice([0, 2]),
+        'speed': round(rng.uniform(0.98, 1.02), 4),
+        'ts_offset': round(rng.uniform(0, 0.1), 3),
+        'audio_bitrate': rng.choice(['96k', '128k', '160k']),
+        'tags': random_metadata_tags(rng),
+        'chapter': rng.random() < 0.5,
+        'subtitle': rng.random() < 0.5,
+    }
+    if info.video_codec == 'h264':
+        # h264_metadata inserts this as an unregistered user data SEI (UUID+string)
+        params['sei_user_data'] = f"{rng.getrandbits(128):032x}+{rng.getrandbits(32):08x}"
+    return params
+
+def bitstream_filter_chain(params, info):
+    """-bsf:v chain for params: SEI/AUD/crop edits, then the timestamp rescale"""
+    video = next(s for s in info.streams if s.get('codec_type') == 'video')
+    chain = []
+    if params['drop_sei']:
+        chain.append(f"filter_units=remove_types={SEI_NAL_TYPES[info.video_codec]}")
+    options = [f"aud={params['aud']}"]
+    # The crop replaces the stream's own (e.g. 1088 -> 1080), so it is added on top of it
+    coded_width = int(video.get('coded_width') or 0)
+    if params['extra_crop'] and info.video_codec == 'h264' and coded_width >= info.width:
+        options.append(f"crop_right={coded_width - info.width + params['extra_crop']}")
+    if params.get('sei_user_data'):
+        options.append(f"sei_user_data={params['sei_user_data']}")
+    chain.append(f"{BITSTREAM_METADATA_BSF[info.video_codec]}={':'.join(options)}")
+    speed = params['speed']
+    if speed != 1:
+        chain.append(f"setts=pts=PTS/{speed}:dts=DTS/{speed}:duration=DURATION/{speed}")
+    return ','.join(chain)
+
+def generate_bitstream_variant(input_video, output_video, seed, task=None):
+    """Bitstream-mode variant of input_video in one stream-copy mux; returns the params used.
+
+    The video is never decoded: its NAL units are edited by bitstream
+    filters and its timestamps rescaled for the speed change, which the
+    re-encoded audio follows with atempo. Tags, chapter and subtitle come
+    from the container stage in the same pass.
+    """
+    info = probe_media(input_video)
+    if not supports_bitstream_mode(info):
+        raise RuntimeError(f"Bitstream mode needs H.264 or HEVC video, got {info.video_codec}")
+    params = bitstream_variant_params(seed, info)
+    print(f"[Bitstream] seed={seed} => {params}")
+    if task:
+        task.update_state(state='PROCESSING', meta={'status': 'Writing bitstream variant...'})
+
+    audio_options = None
+    if info.has_audio:
+        audio_options = ["-c:a", "aac", "-b:a", params['audio_bitrate'], "-af", f"atempo={params['speed']}"]
+    apply_container_stage(input_video, output_video, strip_metadata=True, tags=params['tags'],
+                          chapter=params['chapter'], subtitle=params['subtitle'],
+                          video_bsf=bitstream_filter_chain(params, info), audio_options=audio_options,
+                          output_options=["-output_ts_offset", str(params['ts_offset']),
+                                          "-movflags", "+faststart"],
+                          rng=random.Random(f"{seed}-container"))
+    if not os.path.exists(output_video) or os.path.getsize(output_video) == 0:
+        raise RuntimeError(f"Generated file is missing or empty: {output_video}")
+    return params
+
+VARIANT_TIMEOUT = int(os.environ.get('VARIANT_TIMEOUT', '1800'))  # Seconds per ffmpeg run of one variant
+
+def generate_variants_concurrently(input_video, output_videos, orientation='horizontal', task=None,
+                                   num_transforms=0, quality=DEFAULT_QUALITY, fallback_input=None,
+                                   concurrency=None, recipes=None, copied=None):
+    """Encode independent variants as overlapping ffmpeg processes.
+
+    Each variant goes through the same steps as generate_unique_video
+    (stream copy when can_stream_copy allows it, otherwise one
+    filter_complex encode); a variant whose steps all fail is saved as a
+    stream copy of fallback_input, and added to the copied list if one is
+    given. At most `concurrency` ffmpeg processes run at once, by default
+    one per available core. recipes, if given, has one VariantRecipe per
+    output. Returns the outputs that were written.
+    """
+    concurrency = concurrency or min(len(output_videos), available_cpus())
+    recipes = recipes or [None] * len(output_videos)
+    return asyncio.run(_generate_variants_async(input_video, output_videos, orientation, task,
+                                                num_transforms, quality, fallback_input, concurrency,
+                                                recipes, copied))
+
+async def _generate_variants_async(input_video, output_videos, orientation, task, num_transforms,
+                                   quality, fallback_input, concurrency, recipes, copied):
+    runner = AsyncProcessRunner(concurrency)
+    video_encoder = detect_video_encoder()
+    info = probe_media(input_video)
+    count = len(output_videos)
+    reporter = ProgressReporter(task)
+    out_times = [0.0] * count
+    started = time.monotonic()
+
+    if task:
+        task.update_state(state='PROCESSING',
+                          meta={'status': f'Processing {info.width}x{info.height} video into {count} variants '
+                                          f'using {video_encoder}, {concurrency} at a time...'})
+
+    def progress_reader(i):
+        def on_line(line):
+            key, _, value = line.strip().partition('=')
+            if key != 'out_time_us' or info.duration <= 0:
+                return
+            out_times[i] = _parse_float(value) / 1_000_000
+            percent = sum(min(t / info.duration, 1.0) for t in out_times) / count * 100
+            if percent > 0:
+                eta = (time.monotonic() - started) * (100 - percent) / percent
+                reporter.update({
+                    'status': f'Encoding {count} variants: {percent:.1f}%, ETA {int(eta)}s',
+                    'percent': round(percent, 1),
+                    'eta': int(eta),
+                })
+        return on_line
+
+    async def encode(i, output_video):
+        attempts = []
+        if can_stream_copy(input_video, num_transforms):
+            attempts.append(copy_command(input_video, output_video))
+        pipeline = FilterPipeline().add_video(downscale_filter(info.width, info.height))
+        build_variant_pipeline(num_transforms, pipeline, orientation, recipes[i])
+        pipeline.add_video(encoder_upload_filter(video_encoder))
+        attempts.append(with_progress_output(
+            variant_encode_command(input_video, output_video, info, pipeline, video_encoder, quality)))
+        fallback = copy_command(fallback_input, output_video) if fallback_input else None
+        if fallback:
+            attempts.append(fallback)
+
+        for cmd in attempts:
+            try:
+                await runner.run(cmd, timeout=VARIANT_TIMEOUT, on_line=progress_reader(i))
+            except subprocess.CalledProcessError as e:
+                print(f"ffmpeg failed for {output_video}: {e.stderr}")
+                continue
+            except asyncio.TimeoutError:
+                print(f"ffmpeg timed out after {VARIANT_TIMEOUT}s for {output_video}")
+                continue
+            if os.path.exists(output_video) and os.path.getsize(output_video) > 0:
+                print(f"[DONE] => {output_video}")
+                if cmd is fallback and copied is not None:
+                    copied.append(output_video)
+                return output_video
+        print(f"Failed to generate {output_video}")
+        return None
+
+    results = await asyncio.gather(*(encode(i, output_video) for i, output_video in enumerate(output_videos)))
+    reporter.flush()
+    return [output_video for output_video in results if output_video]
+
+def get_media_duration(filepath):
+    try:
+        return probe_media(filepath).duration
+    except:
+        return 0.0
+
+# Overrides the detected CPU count (e.g. when the worker shares its quota)
+WORKER_CPUS = int(os.environ.get('WORKER_CPUS', '0'))
+
+def cgroup_cpu_limit():
+    """CPUs the container's CFS quota allows (rounded up), None without a quota"""
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            # cgroup v1: quota is -1 when unlimited
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                quota = f.read().strip()
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = f.read().strip()
+        except OSError:
+            return None
+    try:
+        quota, period = int(quota), int(period)
+    except ValueError:
+        # "max"
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return max(1, math.ceil(quota / period))
+
+def available_cpus():
+    if WORKER_CPUS > 0:
+        return WORKER_CPUS
+    # Respect container CPU affinity where the platform exposes it
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = max(1, len(os.sched_getaffinity(0)))
+    else:
+        cpus = os.cpu_count() or 1
+    # A CPU quota (docker --cpus) does not show in the affinity mask
+    limit = cgroup_cpu_limit()
+    return min(cpus, limit) if limit else cpus
+
+def split_at_keyframes(input_video, segment_dir, segment_seconds):
+    """Stream-copy the video track into GOP-aligned segments.
+
+    With -c copy the segment muxer can only cut on keyframes, so every
+    segment starts with an IDR frame and can be encoded independently.
+    """
+    pattern = os.path.join(segment_dir, "seg_%04d.mp4")
+    cmd = [
+        "ffmpeg", "-y", "-nostdin",
+        "-i", input_video,
+        "-map", "0:v:0", "-an",
+        "-c", "copy",
+        "-f", "segment",
+        "-segment_time", str(segment_seconds),
+        "-reset_timestamps", "1",
+        pattern
+    ]
+    run_process(cmd, check=True, capture_output=True)
+    return sorted(os.path.join(segment_dir, f) for f in os.listdir(segment_dir)
+                  if f.startswith("seg_"))
+
+def encode_video_segment(segment, output_segment, video_filter, encoder_opts, input_args=()):
+    cmd = ["ffmpeg", "-y", "-nostdin"]
+    cmd.extend(input_args)
+    cmd.extend([
+        "-i", segment,
+        "-vf", video_filter,
+        "-an",
+    ])
+    cmd.extend(encoder_opts)
+    cmd.append(output_segment)
+    result = run_process(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Segment encode failed on {segment}\n{result.stderr}")
+    return output_segment
+
+def concat_segments(segments, audio_track, output_video):
+    """Join encoded segments with the concat demuxer, muxing in the audio, without re-encoding"""
+    list_file = os.path.join(os.path.dirname(segments[0]), "concat.txt")
+    with open(list_file, 'w', encoding='utf-8') as f:
+        for segment in segments:
+            f.write(f"file '{os.path.abspath(segment)}'\n")
+    cmd = [
+        "ffmpeg", "-y", "-nostdin",
+        "-f", "concat", "-safe", "0",
+        "-i", list_file,
+    ]
+    if audio_track:
+        cmd.extend(["-i", audio_track, "-map", "0:v", "-map", "1:a"])
+    cmd.extend(["-c", "copy", "-movflags", "+faststart", output_video])
+    run_process(cmd, check=True, capture_output=True)
+
+def generate_segmented_video(input_video, output_video, pipeline, video_encoder,
+                             segment_seconds=60, workers=None, task=None, quality=DEFAULT_QUALITY):
+    """Encode a long input as GOP-aligned segments in parallel.
+
+    The video track is split at keyframes, every segment is encoded with
+    the same pipeline (same randomized parameters) by a pool of ffmpeg
+    processes, and the results are joined with the concat demuxer. Audio is
+    filtered and encoded once for the whole file to avoid gaps at segment
+    boundaries.
+    """
+    workers = workers or available_cpus()
+    # Give each ffmpeg its share of the cores instead of letting all of them use every core
+    encoder_opts = video_encoder_options(video_encoder, quality)
+    encoder_opts.extend(["-threads", str(max(1, available_cpus() // workers))])
+
+    with tempfile.TemporaryDirectory() as segment_dir:
+        segments = split_at_keyframes(input_video, segment_dir, segment_seconds)
+        if not segments:
+            raise RuntimeError("Splitting produced no segments")
+        print(f"[Segments] {len(segments)} segments, {workers} workers")
+
+        # Time-based filters (fade-in) must only run on the first segment,
+        # since every segment's timestamps start at zero
+        first_filter = pipeline.video_chain()
+        rest_filter = pipeline.without("fade=").video_chain()
+
+        # A missing audio stream makes this run fail, which just means no audio track
+        audio_track = os.path.join(segment_dir, "audio.m4a")
+        cmd = [
+            "ffmpeg", "-y", "-nostdin",
+            "-i", input_video,
+            "-vn", "-map", "0:a:0?",
+            "-af", pipeline.audio_chain(),
+            "-c:a", "aac", "-b:a", "96k", "-ac", "2", "-ar", "44100",
+            audio_track
+        ]
+        result = run_process(cmd, capture_output=True, text=True)
+        if result.returncode != 0 or not os.path.exists(audio_track) or os.path.getsize(audio_track) == 0:
+            audio_track = None
+
+        outputs = [os.path.join(segment_dir, f"enc_{i:04d}.mp4") for i in range(len(segments))]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(encode_video_segment, segment, out,
+                            first_filter if i == 0 else rest_filter, encoder_opts,
+                            encoder_input_args(video_encoder))
+                for i, (segment, out) in enumerate(zip(segments, outputs))
+            ]
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                if task:
+                    task.update_state(state='PROCESSING',
+                                      meta={'status': f'Encoding segments: {done}/{len(segments)}'})
+
+        concat_segments(outputs, audio_track, output_video)
+
+def generate_unique_variants(input_video, output_videos, orientation='horizontal', task=None, num_transforms=0,
+                             quality=DEFAULT_QUALITY, recipes=None):
+    """Fan-out mode: write every variant from a single decode of input_video.
+
+    The source is decoded once and split with split/asplit inside one
+    -filter_complex graph; each branch gets its own recipe pipeline
+    (random transforms plus setpts/atempo) and its own encoder output.
+    """
+    try:
+        count = len(output_videos)
+        if task:
+            task.update_state(state='PROCESSING', meta={'status': f'Analyzing input video for {count} variants...'})
+
+        video_encoder = detect_video_encoder()
+        info = probe_media(input_video)
+        w, h, total_frames = info.width, info.height, info.total_frames
+
+        if task:
+            task.update_state(state='PROCESSING',
+                            meta={'status': f'Processing {w}x{h} video into {count} variants using {video_encoder}, estimated {total_frames} frames...'})
+
+        recipes = recipes or [None] * count
+        pipelines = [build_variant_pipeline(num_transforms, orientation=orientation, recipe=recipe)
+                     for recipe in recipes]
+
+        # Shared part of the graph: optional downscale, then split once
+        shared = []
+        scale_filter = downscale_filter(w, h)
         if scale_filter:
-            filters.append(scale_filter.rstrip(','))
-        filters.append(f"setpts=PTS/{sp}")
-        
-        video_filter = ','.join(filters)
-        audio_filter = f"atempo={sp}"
+            shared.append(scale_filter)
+        shared.append(f"split={count}" + ''.join(f"[v{i}]" for i in range(count)))
+        graph = [f"[0:v]{','.join(shared)}"]
+        if info.has_audio:
+            graph.append(f"[0:a]asplit={count}" + ''.join(f"[a{i}]" for i in range(count)))
+        for i, pipeline in enumerate(pipelines):
+            pipeline.add_video(encoder_upload_filter(video_encoder))
+            graph.append(pipeline.filter_complex(f"v{i}", f"a{i}", f"vo{i}", f"ao{i}",
+                                                 with_audio=info.has_audio))
+
+        cmd = ["ffmpeg", "-y", "-nostdin", "-hwaccel", "auto"]
+        cmd.extend(encoder_input_args(video_encoder))
+        cmd.extend(["-i", input_video, "-filter_complex", ';'.join(graph)])
+        encoder_opts = video_encoder_options(video_encoder, quality)
+        for i, output_video in enumerate(output_videos):
+            cmd.extend(["-map", f"[vo{i}]"])
+            if info.has_audio:
+                cmd.extend(["-map", f"[ao{i}]"])
+            cmd.extend(encoder_opts)
+            cmd.extend(pipelines[i].output_options)
+            cmd.append(output_video)
 
-        # Optimized FFmpeg command with hardware acceleration
+        print(f"[Fan-out] {count} variants")
+        run_ffmpeg_with_progress(cmd, info.duration, task)
+
+        for output_video in output_videos:
+            if not os.path.exists(output_video) or os.path.getsize(output_video) == 0:
+                raise RuntimeError(f"Generated file is missing or empty: {output_video}")
+            print(f"[DONE] => {output_video}")
+
+    except Exception as e:
+        print(f"Error in generate_unique_variants: {str(e)}")
+        raise
+
+# Content-addressed store of cleaned sources, shared by repeat uploads
+CONTENT_STORE_DIR = os.environ.get('CONTENT_STORE_DIR', 'content_store')
+LARGE_INPUT_BYTES = 100 * 1024 * 1024  # Inputs above this are always re-encoded (downscale + rate cap)
+
+def new_content_hasher():
+    return hashlib.blake2b(digest_size=20)
+
+def hash_file(filepath, block_size=1024 * 1024):
+    hasher = new_content_hasher()
+    with open(filepath, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def temp_output_path(target):
+    """Temporary name next to target; the extension is kept for ffmpeg's format detection"""
+    base, ext = os.path.splitext(target)
+    return f"{base}.tmp-{os.getpid()}-{threading.get_ident()}{ext}"
+
+def _store_atomically(produce, target):
+    """Run produce(tmp_path) and move the result into place only if it succeeded"""
+    tmp_path = temp_output_path(target)
+    try:
+        produce(tmp_path)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def write_outputs_atomically(produce, targets):
+    """Run produce({target: tmp_path}) and move every non-empty result onto its target.
+
+    An interrupted encode leaves at most a *.tmp-* file behind, never a
+    truncated file under an output name. Returns the targets written.
+    """
+    tmp_paths = {target: temp_output_path(target) for target in targets}
+    try:
+        produce(tmp_paths)
+        written = []
+        for target, tmp_path in tmp_paths.items():
+            if os.path.exists(tmp_path) and os.path.getsize(tmp_path) > 0:
+                os.replace(tmp_path, target)
+                written.append(target)
+        return written
+    finally:
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def prepare_source(in_path, temp_dir, content_hash=None, task=None):
+    """Strip metadata once per source and return the path to encode from.
+
+    With a content_hash the cleaned file is kept in the content store, so a
+    repeat upload of the same bytes goes straight to variant generation.
+    Large inputs are not compressed here: downscale and rate cap are part
+    of every variant's encode (see plan_variant_encodes).
+    """
+    work_dir = temp_dir
+    if content_hash:
+        work_dir = os.path.join(CONTENT_STORE_DIR, content_hash)
+        os.makedirs(work_dir, exist_ok=True)
+        cached = os.path.join(work_dir, "clean_input.mp4")
+        if os.path.exists(cached) and os.path.getsize(cached) > 0:
+            # Refresh mtime so the store sweep keeps entries that are still in use
+            os.utime(cached)
+            print(f"Reusing stored source for {content_hash}")
+            return cached
+
+    clean_input = os.path.join(work_dir, "clean_input.mp4")
+    try:
+        _store_atomically(lambda tmp: remove_all_metadata(in_path, tmp), clean_input)
+        print("Successfully removed metadata")
+    except Exception as e:
+        print(f"Error cleaning metadata: {str(e)}")
+        print(f"Using original file: {in_path}")
+        clean_input = in_path
+
+    try:
+        get_video_dimensions(clean_input)
+        print("Successfully verified cleaned file")
+    except Exception as e:
+        print(f"Error with cleaned file: {str(e)}")
+        print(f"Using original file: {in_path}")
+        clean_input = in_path
+    return clean_input
+
+def plan_variant_encodes(source, num_variants, fanout=False, segment_seconds=0, renditions=None, bitstream=False):
+    """Decide once per source how its variants are encoded.
+
+    Every strategy is a single encode per output from the source (downscale,
+    rate cap and transforms in one graph), except bitstream:
+    'renditions' - all variants and renditions from one decode
+    'bitstream'  - no encode, one remux per variant (H.264/HEVC sources)
+    'fanout'     - all variants from one decode; also used for large
+                   multi-variant sources so they are decoded only once
+    'segmented'  - one segment-parallel encode per variant
+    'concurrent' - overlapping per-variant encodes
+    'single'     - one encode at a time
+    """
+    if renditions:
+        return 'renditions'
+    if bitstream and supports_bitstream_mode(probe_media(source)):
+        return 'bitstream'
+    if num_variants > 1 and fanout:
+        return 'fanout'
+    if segment_seconds and get_media_duration(source) > 2 * segment_seconds:
+        return 'segmented'
+    if num_variants > 1 and os.path.getsize(source) > LARGE_INPUT_BYTES:
+        return 'fanout'
+    if num_variants > 1:
+        return 'concurrent'
+    return 'single'
+
+def plan_encodes(strategy, source, num_transforms=0):
+    """Whether a strategy re-encodes: bitstream variants are remuxed, and the
+    per-variant strategies stream-copy a source can_stream_copy allows"""
+    if strategy == 'bitstream':
+        return False
+    if strategy in ('renditions', 'fanout'):
+        return True
+    return not can_stream_copy(source, num_transforms)
+
+# Режим целевого качества: кандидаты на шкале CRF x264, от лучшего к худшему
+QUALITY_CANDIDATES = [23, 26, 29, 32, 35, 38]
+QUALITY_SAMPLES = 3           # Sample segments spread over the input
+QUALITY_SAMPLE_SECONDS = 2
+
+def measure_quality(reference, distorted, metric='ssim'):
+    """SSIM (0-1) or VMAF (0-100) of distorted against reference, same frame size"""
+    if metric == 'vmaf':
+        graph = "[0:v][1:v]libvmaf"
+        marker = "VMAF score:"
+    else:
+        graph = "[0:v][1:v]ssim"
+        marker = "All:"
+    cmd = [
+        "ffmpeg", "-hide_banner", "-nostdin",
+        "-i", distorted,
+        "-i", reference,
+        "-lavfi", graph,
+        "-f", "null", "-"
+    ]
+    result = run_process(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Quality measurement failed\n{result.stderr[-2000:]}")
+    for line in reversed(result.stderr.splitlines()):
+        if marker in line:
+            return float(line.split(marker, 1)[1].split()[0])
+    raise RuntimeError(f"No {metric} score in ffmpeg output")
+
+def extract_quality_samples(input_video, sample_dir, duration):
+    """Cut short near-lossless reference samples at the size variants are encoded at"""
+    samples = []
+    length = min(QUALITY_SAMPLE_SECONDS, duration)
+    for i in range(QUALITY_SAMPLES):
+        start = max(0.0, duration * (i + 1) / (QUALITY_SAMPLES + 1) - length / 2)
+        sample = os.path.join(sample_dir, f"ref_{i}.mkv")
         cmd = [
             "ffmpeg", "-y", "-nostdin",
-            "-hwaccel", "auto",
+            "-ss", f"{start:.3f}",
             "-i", input_video,
-            "-filter_complex", f"[0:v]{video_filter}[v];[0:a]{audio_filter}[a]",
-            "-map", "[v]", "-map", "[a]",
-            "-c:v", video_encoder,
+            "-t", f"{length:.3f}",
+            "-an",
+            "-vf", DOWNSCALE_FILTER + "," + EVEN_DIMENSIONS_FILTER,
+            "-c:v", "libx264", "-preset", "ultrafast", "-qp", "0",
+            sample
         ]
+        run_process(cmd, check=True, capture_output=True)
+        samples.append(sample)
+        if duration <= length:
+            break
+    return samples
 
-        # Add encoder-specific options
-        if video_encoder == 'libx264':
-            cmd.extend([
-                "-preset", "ultrafast",
-                "-tune", "zerolatency",
-                "-profile:v", "high",
-                "-level", "4.1",
-            ])
-        elif video_encoder in ['h264_nvenc', 'h264_videotoolbox']:
+def select_quality(input_video, target, metric='ssim', video_encoder=None):
+    """Highest quality value (x264 CRF scale) whose worst sample still meets target"""
+    video_encoder = video_encoder or detect_video_encoder()
+    duration = probe_media(input_video).duration
+    if duration <= 0:
+        raise RuntimeError("Unknown input duration")
+
+    with tempfile.TemporaryDirectory() as sample_dir:
+        samples = extract_quality_samples(input_video, sample_dir, duration)
+        for quality in reversed(QUALITY_CANDIDATES):
+            scores = []
+            for i, sample in enumerate(samples):
+                encoded = os.path.join(sample_dir, f"enc_{i}_{quality}.mp4")
+                cmd = ["ffmpeg", "-y", "-nostdin"]
+                cmd.extend(encoder_input_args(video_encoder))
+                cmd.extend(["-i", sample, "-an"])
+                upload = encoder_upload_filter(video_encoder)
+                if upload:
+                    cmd.extend(["-vf", upload])
+                cmd.extend(video_encoder_options(video_encoder, quality))
+                cmd.append(encoded)
+                run_process(cmd, check=True, capture_output=True)
+                scores.append(measure_quality(sample, encoded, metric))
+            print(f"[Quality] {video_encoder} q={quality}: worst {metric} {min(scores):.4f}")
+            if min(scores) >= target:
+                return quality
+    return QUALITY_CANDIDATES[0]
+
+def choose_quality(input_video, target, metric='ssim', content_hash=None):
+    """select_quality, cached in the content store per source hash and settings"""
+    video_encoder = detect_video_encoder()
+    key = f"{metric}:{target}:{video_encoder}"
+    cache_path = None
+    if content_hash:
+        cache_path = os.path.join(CONTENT_STORE_DIR, content_hash, "quality.json")
+        try:
+            with open(cache_path, encoding='utf-8') as f:
+                cached = json.load(f)
+            if key in cached:
+                print(f"Reusing quality decision for {content_hash}: {cached[key]}")
+                return cached[key]
+        except (OSError, ValueError):
+            cached = {}
+    quality = select_quality(input_video, target, metric, video_encoder)
+
+    if cache_path:
+        cached[key] = quality
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+        def write(tmp):
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(cached, f)
+        try:
+            _store_atomically(write, cache_path)
+        except OSError as e:
+            print(f"Error caching quality decision: {str(e)}")
+    return quality
+
+# Лестница качеств: короткая сторона кадра и ограничения битрейта
+RENDITION_LADDER = {
+    '1080p': {'size': 1080, 'maxrate': '5000k', 'bufsize': '10000k', 'audio_bitrate': '128k'},
+    '720p': {'size': 720, 'maxrate': '2000k', 'bufsize': '4000k', 'audio_bitrate': '96k'},
+    'preview': {'size': 360, 'maxrate': '600k', 'bufsize': '1200k', 'audio_bitrate': '64k'},
+}
+
+def parse_renditions(value):
+    """Rendition names from a list or comma-separated string, validated against RENDITION_LADDER"""
+    if not value:
+        return []
+    names = value.split(',') if isinstance(value, str) else list(value)
+    names = [n.strip() for n in names if n and n.strip()]
+    unknown = [n for n in names if n not in RENDITION_LADDER]
+    if unknown:
+        raise ValueError(f"Unknown renditions: {', '.join(unknown)}")
+    return list(dict.fromkeys(names))
+
+def rendition_scale_filter(name, orientation='horizontal'):
+    # Scale the short side down to the rendition size, never up, keeping dimensions even
+    size = RENDITION_LADDER[name]['size']
+    if orientation == 'vertical':
+        return f"scale=trunc(min({size}\\,iw)/2)*2:-2"
+    return f"scale=-2:trunc(min({size}\\,ih)/2)*2"
+
+def rendition_output_name(variant_number, name):
+    return f"{variant_number}_{name}.mp4"
+
+def generate_rendition_variants(input_video, variant_outputs, orientation='horizontal', task=None,
+                                num_transforms=0, quality=DEFAULT_QUALITY, recipes=None):
+    """Write every variant in every rendition from a single decode.
+
+    variant_outputs is a list with one {rendition name: output path} dict
+    per variant. The graph splits the source once per variant, applies that
+    variant's recipe, then splits again into one scale + encoder per
+    rendition.
+    """
+    try:
+        count = len(variant_outputs)
+        info = probe_media(input_video)
+        video_encoder = detect_video_encoder()
+
+        if task:
+            task.update_state(state='PROCESSING',
+                            meta={'status': f'Processing {info.width}x{info.height} video into {count} variants '
+                                            f'x {len(variant_outputs[0])} renditions using {video_encoder}...'})
+
+        graph = [f"[0:v]split={count}" + ''.join(f"[v{i}]" for i in range(count))]
+        if info.has_audio:
+            graph.append(f"[0:a]asplit={count}" + ''.join(f"[a{i}]" for i in range(count)))
+
+        outputs = []
+        recipes = recipes or [None] * count
+        for i, renditions in enumerate(variant_outputs):
+            pipeline = build_variant_pipeline(num_transforms, orientation=orientation, recipe=recipes[i])
+            names = list(renditions)
+            k = len(names)
+            graph.append(f"[v{i}]{pipeline.video_chain()},split={k}" + ''.join(f"[v{i}r{j}]" for j in range(k)))
+            if info.has_audio:
+                graph.append(f"[a{i}]{pipeline.audio_chain()},asplit={k}" + ''.join(f"[a{i}r{j}]" for j in range(k)))
+            for j, name in enumerate(names):
+                scale = ','.join(filter(None, [rendition_scale_filter(name, orientation),
+                                               encoder_upload_filter(video_encoder)]))
+                graph.append(f"[v{i}r{j}]{scale}[vo{i}r{j}]")
+                outputs.append((f"vo{i}r{j}", f"a{i}r{j}", name, pipeline, renditions[name]))
+
+        cmd = ["ffmpeg", "-y", "-nostdin", "-hwaccel", "auto"]
+        cmd.extend(encoder_input_args(video_encoder))
+        cmd.extend(["-i", input_video, "-filter_complex", ';'.join(graph)])
+        encoder_opts = video_encoder_options(video_encoder, quality)
+        for video_label, audio_label, name, pipeline, output_video in outputs:
+            rendition = RENDITION_LADDER[name]
+            cmd.extend(["-map", f"[{video_label}]"])
+            if info.has_audio:
+                cmd.extend(["-map", f"[{audio_label}]"])
+            cmd.extend(encoder_opts)
+            cmd.extend(pipeline.output_options)
+            # Per-rendition rate caps override the shared encoder defaults
             cmd.extend([
-                "-preset", "p1",  # Fastest preset for NVENC
-                "-tune", "ll",    # Low latency tuning
-                "-profile:v", "high",
+                "-maxrate", rendition['maxrate'],
+                "-bufsize", rendition['bufsize'],
+                "-b:a", rendition['audio_bitrate'],
+                output_video
             ])
 
-        # Common parameters
-        cmd.extend([
-            "-crf", "35",
-            "-maxrate", "2000k",
-            "-bufsize", "4000k",
-            "-pix_fmt", "yuv420p",
-            "-c:a", "aac",
-            "-b:a", "96k",
-            "-ac", "2",
-            "-ar", "44100",
-            "-movflags", "+faststart",
-            "-threads", "0",
-            "-g", "60",
-            "-vsync", "1",
-            "-async", "1",
-            output_video
-        ])
-
-        # Run FFmpeg with timeout
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
-        )
-
-        last_progress_time = time.time()
-        progress_timeout = 300  # 5 minutes timeout for progress
-        
-        # Monitor progress
-        while True:
-            line = process.stderr.readline()
-            if not line and process.poll() is not None:
-                break
-                
-            if "frame=" in line:
+        print(f"[Renditions] {count} variants x {list(variant_outputs[0])}")
+        run_ffmpeg_with_progress(cmd, info.duration, task)
+
+        for _, _, _, _, output_video in outputs:
+            if not os.path.exists(output_video) or os.path.getsize(output_video) == 0:
+                raise RuntimeError(f"Generated file is missing or empty: {output_video}")
+            print(f"[DONE] => {output_video}")
+
+    except Exception as e:
+        print(f"Error in generate_rendition_variants: {str(e)}")
+        raise
+
+def is_streamable_mp4(header):
+    """True if the top-level boxes in header reach moov/moof before mdat.
+
+    That is the case for faststart and fragmented MP4/MOV files, which can
+    be demuxed front to back while the rest of the file is still arriving.
+    """
+    offset = 0
+    while offset + 8 <= len(header):
+        size = int.from_bytes(header[offset:offset + 4], 'big')
+        box = header[offset + 4:offset + 8]
+        if box in (b'moov', b'moof'):
+            return True
+        if box == b'mdat':
+            return False
+        if size == 1:
+            if offset + 16 > len(header):
+                return False
+            size = int.from_bytes(header[offset + 8:offset + 16], 'big')
+        if size < 8:
+            return False
+        offset += size
+    return False
+
+def feed_growing_file(paths, pipe, available_bytes, total_size, poll_interval=0.5, stall_timeout=300,
+                      block_size=1024 * 1024):
+    """Copy a file that is still being written into pipe.
+
+    paths are tried in order until one can be opened (the upload is renamed
+    when it completes; an already open descriptor stays valid). Only the
+    first available_bytes() bytes are read, polling until total_size bytes
+    have been written.
+    """
+    f = None
+    last_growth = time.time()
+    try:
+        while f is None:
+            for path in paths:
                 try:
-                    current_time = time.time()
-                    frame = int(line.split("frame=")[1].split()[0])
-                    fps = float(line.split("fps=")[1].split()[0])
-                    time_str = line.split("time=")[1].split()[0]
-                    
-                    # Update last progress time
-                    last_progress_time = current_time
-                    
-                    if total_frames > 0:
-                        progress = (frame / total_frames) * 100
-                        status = f'Processing: {frame}/{total_frames} frames ({progress:.1f}%) @ {fps:.1f} fps'
-                    else:
-                        status = f'Processing: {frame} frames @ {fps:.1f} fps'
-                    
-                    if task:
-                        task.update_state(state='PROCESSING', meta={'status': status})
-                except Exception as e:
-                    print(f"Error parsing progress: {str(e)}")
-                    
-            # Check for timeout
-            if time.time() - last_progress_time > progress_timeout:
-                process.kill()
-                raise RuntimeError("Processing timeout - no progress for 5 minutes")
-
-        # Check process result
-        if process.wait() != 0:
-            error_output = process.stderr.read()
-            raise RuntimeError(f"FFmpeg failed: {error_output}")
+                    f = open(path, 'rb')
+                    break
+                except FileNotFoundError:
+                    continue
+            if f is None:
+                if time.time() - last_growth > stall_timeout:
+                    raise RuntimeError(f"Upload never appeared: {paths}")
+                time.sleep(poll_interval)
 
-        if task:
-            task.update_state(state='PROCESSING', meta={'status': 'Verifying output...'})
+        written = 0
+        while written < total_size:
+            limit = min(available_bytes(), total_size)
+            if limit > written:
+                f.seek(written)
+                block = f.read(min(limit - written, block_size))
+                pipe.write(block)
+                written += len(block)
+                last_growth = time.time()
+            elif time.time() - last_growth > stall_timeout:
+                raise RuntimeError("Upload stalled - no new data for 5 minutes")
+            else:
+                time.sleep(poll_interval)
+    except BrokenPipeError:
+        print("ffmpeg closed its input early")
+    finally:
+        if f is not None:
+            f.close()
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
 
-        # Verify the output
-        if not os.path.exists(output_video) or os.path.getsize(output_video) == 0:
-            raise RuntimeError("Generated file is missing or empty")
+def generate_streamed_variants(feed, output_videos, orientation='horizontal', task=None, num_transforms=0,
+                               recipes=None):
+    """Streaming mode: encode variants from ffmpeg's stdin while the upload is still arriving.
+
+    feed(pipe) writes the source into ffmpeg's stdin. The input has not been
+    probed, so the downscale cap is applied unconditionally (it is a no-op
+    for small inputs) and audio is mapped optionally. Outputs are
+    fragmented MP4 so they are written progressively instead of needing a
+    final faststart rewrite.
+    """
+    video_encoder = detect_video_encoder()
+    cmd = ["ffmpeg", "-y"]
+    cmd.extend(encoder_input_args(video_encoder))
+    cmd.extend(["-f", "mov", "-i", "pipe:0"])
+    encoder_opts = video_encoder_options(video_encoder)
+    recipes = recipes or [None] * len(output_videos)
+    for output_video, recipe in zip(output_videos, recipes):
+        pipeline = FilterPipeline().add_video(DOWNSCALE_FILTER)
+        build_variant_pipeline(num_transforms, pipeline, orientation, recipe)
+        pipeline.add_video(encoder_upload_filter(video_encoder))
+        cmd.extend(["-map", "0:v:0", "-map", "0:a:0?"])
+        cmd.extend(pipeline.filter_args())
+        cmd.extend(encoder_opts)
+        cmd.extend(pipeline.output_options)
+        cmd.extend(["-movflags", "frag_keyframe+empty_moov", output_video])
 
+    if task:
+        task.update_state(state='PROCESSING', meta={'status': 'Processing video while it uploads...'})
+    print(f"[Stream] {len(output_videos)} variants from stdin")
+    run_ffmpeg_with_progress(cmd, 0, task, stdin_feeder=feed)
+
+    for output_video in output_videos:
+        if not os.path.exists(output_video) or os.path.getsize(output_video) == 0:
+            raise RuntimeError(f"Generated file is missing or empty: {output_video}")
         print(f"[DONE] => {output_video}")
 
+RECIPE_MANIFEST = 'recipes.json'  # Per output dir: output filename -> recipe entry
+RECIPE_MANIFEST_LOCK = RECIPE_MANIFEST + '.lock'
+
+def recipe_entry(recipe, mode, source, content_hash=None, quality=DEFAULT_QUALITY, job_seed=None):
+    """Manifest entry with everything replay_variant needs to rebuild an output.
+
+    A fallback copy of the upload is recorded with mode 'copy' and no recipe:
+    it is listed with the job's outputs but never replayed or kept on resume.
+    """
+    return {
+        'recipe': recipe.to_dict() if recipe else None,
+        'mode': mode,
+        'source': source,
+        'content_hash': content_hash,
+        'quality': quality,
+        'job_seed': job_seed,
+    }
+
+def load_recipe_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, RECIPE_MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_recipe_manifest(output_dir, entries, drop=()):
+    """Merge entries ({output filename: entry}) into the output dir's manifest.
+
+    Variant tasks of one job update the same manifest, so the
+    read-merge-write runs under a lock file next to it.
+    """
+    with open(os.path.join(output_dir, RECIPE_MANIFEST_LOCK), 'a') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = load_recipe_manifest(output_dir)
+        manifest.update(entries)
+        for filename in drop:
+            manifest.pop(filename, None)
+
+        def write(tmp):
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
+        _store_atomically(write, os.path.join(output_dir, RECIPE_MANIFEST))
+    return manifest
+
+# The manifest doubles as the job's checkpoint: an output is recorded with
+# its size and checksum once it is complete, and a retried job skips every
+# output that still matches
+def checkpoint_output(output_dir, filename, entry):
+    path = os.path.join(output_dir, filename)
+    entry = dict(entry, size=os.path.getsize(path), checksum=hash_file(path))
+    save_recipe_manifest(output_dir, {filename: entry})
+    return entry
+
+def output_verified(output_dir, filename, entry):
+    """True if filename is on disk with the size and checksum its entry recorded"""
+    path = os.path.join(output_dir, filename)
+    try:
+        return (entry.get('checksum') is not None and os.path.getsize(path) == entry.get('size')
+                and hash_file(path) == entry['checksum'])
+    except OSError:
+        return False
+
+def verified_variant_outputs(output_dir, number, recipe, manifest=None):
+    """Outputs of variant `number` checkpointed with this recipe; [] unless all of them verify"""
+    if manifest is None:
+        manifest = load_recipe_manifest(output_dir)
+    names = [f for f in manifest if output_number(f) == number]
+    for filename in names:
+        entry = manifest[filename]
+        if (entry.get('mode') == 'copy' or VariantRecipe.from_dict(entry['recipe']).fingerprint() != recipe.fingerprint()
+                or not output_verified(output_dir, filename, entry)):
+            return []
+    return names
+
+def discard_unverified_outputs(output_dir):
+    """Remove everything an interrupted attempt left unfinished; returns the verified outputs kept"""
+    manifest = load_recipe_manifest(output_dir)
+    # Fallback copies go too: the retry gets another chance to encode them
+    verified = [f for f, entry in manifest.items()
+                if entry.get('mode') != 'copy' and output_verified(output_dir, f, entry)]
+    for filename in os.listdir(output_dir):
+        path = os.path.join(output_dir, filename)
+        if filename not in verified and filename not in (RECIPE_MANIFEST, RECIPE_MANIFEST_LOCK) and os.path.isfile(path):
+            print(f"Removing unverified output: {filename}")
+            os.remove(path)
+    stale = [f for f in manifest if f not in verified]
+    if stale:
+        save_recipe_manifest(output_dir, {}, drop=stale)
+    return verified
+
+def recorded_job_seed(output_dir):
+    """job_seed of the outputs already in output_dir's manifest, None if there are none"""
+    for entry in load_recipe_manifest(output_dir).values():
+        if entry.get('job_seed') is not None:
+            return entry['job_seed']
+    return None
+
+def replay_source(entry, input_dir=None):
+    """Source file a manifest entry was built from: the stored clean source or the upload"""
+    content_hash = entry.get('content_hash')
+    if content_hash:
+        stored = os.path.join(CONTENT_STORE_DIR, content_hash, "clean_input.mp4")
+        if os.path.exists(stored) and os.path.getsize(stored) > 0:
+            return stored
+    if input_dir:
+        in_path = os.path.join(input_dir, entry['source'])
+        if os.path.exists(in_path):
+            return in_path
+    raise FileNotFoundError(f"Source {entry['source']} is no longer available")
+
+def replay_variant(output_dir, filename, input_dir=None, task=None):
+    """Rebuild one output from its recipe manifest entry, overwriting it.
+
+    The stored recipe pins every transform parameter, so the rebuilt file
+    matches the original as long as the source, encoder and quality are
+    the same.
+    """
+    entry = load_recipe_manifest(output_dir).get(filename)
+    if entry is None or entry.get('recipe') is None:
+        raise KeyError(f"No recipe recorded for {filename}")
+    recipe = VariantRecipe.from_dict(entry['recipe'])
+    in_path = replay_source(entry, input_dir)
+    out_path = os.path.join(output_dir, filename)
+    print(f"[Replay] {filename} from {in_path} (seed {recipe.seed}, mode {entry['mode']})")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        clean_input = prepare_source(in_path, temp_dir, entry.get('content_hash'), task)
+
+        def produce(tmp_paths):
+            tmp_path = tmp_paths[out_path]
+            if entry['mode'] == 'bitstream':
+                generate_bitstream_variant(clean_input, tmp_path, recipe.seed, task)
+            elif entry.get('rendition'):
+                generate_rendition_variants(clean_input, [{entry['rendition']: tmp_path}], recipe.orientation, task,
+                                            recipe.num_transforms, entry['quality'], [recipe])
+            elif entry['mode'] in ('fanout', 'stream'):
+                generate_unique_variants(clean_input, [tmp_path], recipe.orientation, task, recipe.num_transforms,
+                                         entry['quality'], [recipe])
+            else:
+                generate_unique_video(clean_input, tmp_path, recipe.orientation, task, recipe.num_transforms,
+                                      0, entry['quality'], recipe)
+        if not write_outputs_atomically(produce, [out_path]):
+            raise RuntimeError(f"Replay of {filename} produced no output")
+    checkpoint_output(output_dir, filename, entry)
+    return out_path
+
+def resolve_quality(source, quality_target=0, quality_metric='ssim', content_hash=None, task=None):
+    """Quality for a job: sampled against quality_target if set, DEFAULT_QUALITY otherwise"""
+    if not quality_target:
+        return DEFAULT_QUALITY
+    if task:
+        task.update_state(state='PROCESSING', meta={'status': 'Choosing encoder quality from samples...'})
+    try:
+        quality = choose_quality(source, quality_target, quality_metric, content_hash)
+        print(f"Selected quality {quality} for {quality_metric} >= {quality_target}")
+        return quality
     except Exception as e:
-        print(f"Error in generate_unique_video: {str(e)}")
+        print(f"Error selecting quality, using default: {str(e)}")
+        return DEFAULT_QUALITY
+
+def output_number(filename):
+    """Variant number of an output named <number>[_<rendition>].mp4/.mov, None for anything else"""
+    lower = filename.lower()
+    if not (lower.endswith(".mp4") or lower.endswith(".mov")):
+        return None
+    base, _ = os.path.splitext(filename)
+    try:
+        # Rendition outputs are named <number>_<rendition>
+        return int(base.split('_')[0])
+    except ValueError:
+        # Temporary files (<number>.tmp-...) included
+        return None
+
+def list_outputs(output_dir):
+    return sorted(f for f in os.listdir(output_dir) if output_number(f) is not None)
+
+def largest_output_number(output_dir):
+    """Highest output number already in output_dir, 0 if none"""
+    return max((output_number(f) for f in list_outputs(output_dir)), default=0)
+
+def save_copy_of_original(in_path, out_path, task=None):
+    """Last resort for a failed variant: stream copy of the upload; True if it was written"""
+    try:
+        print("Attempting to save copy of original...")
+        cmd = [
+            "ffmpeg", "-y", "-nostdin",
+            "-i", in_path,
+            "-c", "copy",
+            out_path
+        ]
+        run_process(cmd, check=True)
+        if os.path.exists(out_path) and os.path.getsize(out_path) > 0:
+            print(f"Successfully saved copy of original => {out_path}")
+            return True
+        print("Failed to save copy: file is missing or empty")
         if task:
-            task.update_state(state='FAILURE', meta={'status': str(e), 'error': str(e)})
-        raise
+            task.update_state(state='PROCESSING', meta={'status': 'Failed to save video: generated file is missing or empty'})
+    except Exception as e:
+        print(f"Failed to save copy: {str(e)}")
+        if task:
+            task.update_state(state='PROCESSING', meta={'status': f'Failed to save video: {str(e)}'})
+    return False
+
+def encode_variant(clean_input, in_path, out_path, recipe, task=None, segment_seconds=0, quality=DEFAULT_QUALITY):
+    """generate_unique_video for one recipe, falling back to a copy of in_path.
 
-def main_modified(input_dir, output_dir, num_variants=1, orientation='horizontal', task=None):
+    Returns the checkpoint mode of what was written to out_path: 'variant',
+    'copy' for the fallback, None if nothing was.
+    """
+    copied = []
+
+    def produce(tmp_paths):
+        tmp_path = tmp_paths[out_path]
+        try:
+            generate_unique_video(clean_input, tmp_path, recipe.orientation, task, recipe.num_transforms,
+                                  segment_seconds, quality, recipe)
+            if os.path.exists(tmp_path) and os.path.getsize(tmp_path) > 0:
+                print(f"Successfully generated => {out_path}")
+                return
+            print(f"Generated file is missing or empty: {out_path}")
+        except Exception as e:
+            print(f"Error processing variant: {str(e)}")
+        if save_copy_of_original(in_path, tmp_path, task):
+            copied.append(out_path)
+    if not write_outputs_atomically(produce, [out_path]):
+        return None
+    return 'copy' if copied else 'variant'
+
+def plan_distributed_variants(input_dir, output_dir, num_variants=1, orientation='horizontal', task=None,
+                              fanout=False, num_transforms=0, segment_seconds=0, content_hash=None,
+                              renditions=None, quality_target=0, quality_metric='ssim', seed=None, resume=False,
+                              bitstream=False):
+    """Split a job into one independent work item per variant: returns (items, content_hash).
+
+    items is None to keep the job in one task; content_hash is the source's
+    hash, computed here if it was not given, so main_modified need not read
+    the source again.
+
+    Only single-source jobs whose plan encodes every variant on its own are
+    split; shared-decode plans (fanout, renditions) and bitstream jobs (disk
+    bound, no encode to spread) stay with main_modified.
+    The source is cleaned and the quality chosen here, once, and both are
+    kept in the content store where every worker finds them. Items are
+    plain dicts for encode_variant_item:
+    {'source', 'fallback', 'output', 'segment_seconds', 'quality', 'entry'}.
+    With resume, numbering restarts at 1 as in the interrupted attempt.
+    """
+    if num_variants < 2 or renditions or bitstream:
+        return None, content_hash
+    input_files = [f for f in os.listdir(input_dir) if f.lower().endswith(('.mp4', '.mov'))]
+    if len(input_files) != 1:
+        return None, content_hash
+    fname = input_files[0]
+    in_path = os.path.join(input_dir, fname)
+    try:
+        get_video_dimensions(in_path)
+        if content_hash is None:
+            content_hash = hash_file(in_path)
+    except Exception as e:
+        # main_modified reports invalid inputs
+        print(f"Not splitting job: {str(e)}")
+        return None, content_hash
+    if seed is None:
+        seed = new_seed()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        clean_input = prepare_source(in_path, temp_dir, content_hash, task)
+    if not os.path.exists(clean_input):
+        return None, content_hash
+    strategy = plan_variant_encodes(clean_input, num_variants, fanout, segment_seconds)
+    print(f"Encode plan for {fname}: {strategy}")
+    if strategy == 'fanout':
+        return None, content_hash
+
+    # Sampling takes several test encodes, wasted on variants that are copied
+    quality = DEFAULT_QUALITY
+    if plan_encodes(strategy, clean_input, num_transforms):
+        quality = resolve_quality(clean_input, quality_target, quality_metric, content_hash, task)
+    largest_number = 0 if resume or not os.path.isdir(output_dir) else largest_output_number(output_dir)
+    items = []
+    for number in range(largest_number + 1, largest_number + num_variants + 1):
+        recipe = VariantRecipe(variant_seed(seed, number), num_transforms, orientation)
+        items.append({
+            'source': clean_input,
+            'fallback': in_path,
+            'output': f"{number}.mp4",
+            'segment_seconds': segment_seconds,
+            'quality': quality,
+            'entry': recipe_entry(recipe, 'variant', fname, content_hash, quality, seed),
+        })
+    return items, content_hash
+
+def encode_variant_item(item, output_dir, task=None):
+    """Encode and checkpoint one item from plan_distributed_variants.
+
+    Returns its output name, None if nothing was written. An output an
+    earlier delivery of the same item already checkpointed is kept.
+    """
+    recipe = VariantRecipe.from_dict(item['entry']['recipe'])
+    out_path = os.path.join(output_dir, item['output'])
+    if verified_variant_outputs(output_dir, output_number(item['output']), recipe):
+        print(f"Skipping {item['output']}, verified from a previous attempt")
+        return item['output']
+    print(f"\n[PROCESS] Variant {item['output']} (seed {recipe.seed})")
+    mode = encode_variant(item['source'], item['fallback'], out_path, recipe, task,
+                          item['segment_seconds'], item['quality'])
+    if not mode:
+        return None
+    entry = dict(item['entry'], rendition=None)
+    if mode == 'copy':
+        entry.update(mode='copy', recipe=None)
+    checkpoint_output(output_dir, item['output'], entry)
+    return item['output']
+
+def main_modified(input_dir, output_dir, num_variants=1, orientation='horizontal', task=None, fanout=False,
+                  num_transforms=0, segment_seconds=0, content_hash=None, renditions=None,
+                  quality_target=0, quality_metric='ssim', seed=None, resume=False, bitstream=False):
+    """Generate num_variants outputs per input file into output_dir.
+
+    bitstream asks for the remux-only mode (see generate_bitstream_variant);
+    sources it cannot handle are encoded as usual, without transforms.
+
+    Outputs are numbered after the ones already in output_dir. With resume
+    the job is a retry of one that wrote into output_dir before: numbering
+    starts at 1 again and variants whose checkpointed outputs still verify
+    are kept instead of encoded again.
+    """
+    if seed is None:
+        seed = new_seed()
     print(f"\nStarting main_modified with parameters:")
     print(f"input_dir: {input_dir}")
     print(f"output_dir: {output_dir}")
     print(f"num_variants: {num_variants}")
     print(f"orientation: {orientation}")
+    print(f"fanout: {fanout}")
+    print(f"num_transforms: {num_transforms}")
+    print(f"segment_seconds: {segment_seconds}")
+    print(f"content_hash: {content_hash}")
+    print(f"renditions: {renditions}")
+    print(f"quality_target: {quality_target} ({quality_metric})")
+    print(f"seed: {seed}")
+    print(f"resume: {resume}")
+    print(f"bitstream: {bitstream}")
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
         print(f"Created output directory: {output_dir}")
 
-    largest_number = 0
-    for fn in os.listdir(output_dir):
-        lower = fn.lower()
-        if lower.endswith(".mp4") or lower.endswith(".mov"):
-            base, _ = os.path.splitext(fn)
-            try:
-                val = int(base)
-                if val > largest_number:
-                    largest_number = val
-            except ValueError:
-                pass
+    largest_number = 0 if resume else largest_output_number(output_dir)
     print(f"Starting with largest_number: {largest_number}")
 
     input_files = [f for f in os.listdir(input_dir) 
@@ -696,6 +2290,16 @@ def main_modified(input_dir, output_dir, num_variants=1, orientation='horizontal
     print(f"Found input files: {input_files}")
     successful_outputs = []
 
+    # The upload hash identifies the session's single source file; chunked
+    # uploads are hashed here so /upload/complete does not read the data
+    if len(input_files) != 1:
+        content_hash = None
+    elif content_hash is None:
+        try:
+            content_hash = hash_file(os.path.join(input_dir, input_files[0]))
+        except OSError as e:
+            print(f"Error hashing input: {str(e)}")
+
     for fname in input_files:
         in_path = os.path.join(input_dir, fname)
         print(f"\nProcessing file: {in_path}")
@@ -707,86 +2311,143 @@ def main_modified(input_dir, output_dir, num_variants=1, orientation='horizontal
             print(f"Error getting video dimensions: {str(e)}")
             print(f"Skipping invalid file: {fname}")
             if task:
-                task.update_state(state='FAILURE', meta={'status': f'Invalid video file: {str(e)}', 'error': str(e)})
+                task.update_state(state='PROCESSING', meta={'status': f'Skipping invalid video file: {str(e)}'})
             continue
 
+        # Every variant's parameters come from a seed derived from its output number
+        numbers = [largest_number + i + 1 for i in range(num_variants)]
+        recipes = [VariantRecipe(variant_seed(seed, number), 0 if bitstream else num_transforms, orientation)
+                   for number in numbers]
+        largest_number += num_variants
+
+        if resume:
+            manifest = load_recipe_manifest(output_dir)
+            pending = []
+            for number, recipe in zip(numbers, recipes):
+                done = verified_variant_outputs(output_dir, number, recipe, manifest)
+                if done:
+                    print(f"Keeping variant {number} from a previous attempt: {done}")
+                    successful_outputs.extend(os.path.join(output_dir, f) for f in done)
+                else:
+                    pending.append((number, recipe))
+            if not pending:
+                continue
+            numbers = [number for number, _ in pending]
+            recipes = [recipe for _, recipe in pending]
+        count = len(numbers)
+
         with tempfile.TemporaryDirectory() as temp_dir:
             print(f"Created temporary directory: {temp_dir}")
-            clean_input = os.path.join(temp_dir, "clean_input.mp4")
-            try:
-                remove_all_metadata(in_path, clean_input)
-                print("Successfully removed metadata")
-            except Exception as e:
-                print(f"Error cleaning metadata: {str(e)}")
-                print(f"Using original file: {fname}")
-                clean_input = in_path
+            clean_input = prepare_source(in_path, temp_dir, content_hash, task)
 
-            try:
-                get_video_dimensions(clean_input)
-                print("Successfully verified cleaned file")
-            except Exception as e:
-                print(f"Error with cleaned file: {str(e)}")
-                print(f"Using original file: {fname}")
-                clean_input = in_path
+            strategy = plan_variant_encodes(clean_input, count, fanout, segment_seconds, renditions, bitstream)
+            print(f"Encode plan for {fname}: {strategy}")
 
-            for variant in range(num_variants):
-                largest_number += 1
-                out_name = f"{largest_number}.mp4"
-                out_path = os.path.join(output_dir, out_name)
+            # Sampling takes several test encodes, wasted on variants that are
+            # remuxed or copied; a bitstream job samples on its first fallback
+            quality = DEFAULT_QUALITY
+            if plan_encodes(strategy, clean_input, num_transforms):
+                quality = resolve_quality(clean_input, quality_target, quality_metric, content_hash, task)
 
-                print(f"\n[PROCESS] Variant {variant + 1}/{num_variants}: {fname} => {out_name}")
-                try:
-                    generate_unique_video(clean_input, out_path, orientation, task)
-                    if os.path.exists(out_path) and os.path.getsize(out_path) > 0:
-                        print(f"Successfully generated => {out_path}")
-                        successful_outputs.append(out_path)
-                    else:
-                        print(f"Generated file is missing or empty: {out_path}")
+            def checkpoint(mode, written, outputs, fname=fname):
+                """Record the written outputs ((recipe, paths) per variant) so a retry keeps them"""
+                for recipe, paths in outputs:
+                    for out_path in paths:
+                        if out_path not in written:
+                            continue
+                        rendition = os.path.splitext(os.path.basename(out_path))[0].partition('_')[2]
+                        entry = recipe_entry(None if mode == 'copy' else recipe, mode, fname, content_hash, quality, seed)
                         try:
-                            print("Attempting to save copy of original...")
-                            cmd = [
-                                "ffmpeg", "-y", "-nostdin",
-                                "-i", in_path,
-                                "-c", "copy",
-                                out_path
-                            ]
-                            subprocess.run(cmd, check=True)
-                            if os.path.exists(out_path) and os.path.getsize(out_path) > 0:
-                                print(f"Successfully saved copy of original => {out_path}")
-                                successful_outputs.append(out_path)
-                            else:
-                                print(f"Failed to save copy: file is missing or empty")
-                                if task:
-                                    task.update_state(state='FAILURE', meta={'status': 'Failed to save video', 'error': 'Generated file is missing or empty'})
-                        except Exception as e:
-                            print(f"Failed to save copy: {str(e)}")
-                            if task:
-                                task.update_state(state='FAILURE', meta={'status': f'Failed to save video: {str(e)}', 'error': str(e)})
+                            checkpoint_output(output_dir, os.path.basename(out_path), dict(entry, rendition=rendition or None))
+                        except OSError as e:
+                            print(f"Error checkpointing {out_path}: {str(e)}")
+                        successful_outputs.append(out_path)
+
+            if strategy == 'renditions':
+                # One decode for every variant in every rendition
+                variant_outputs = [
+                    {name: os.path.join(output_dir, rendition_output_name(number, name)) for name in renditions}
+                    for number in numbers
+                ]
+                print(f"\n[PROCESS] {count} variants x {renditions}: {fname}")
+                try:
+                    written = write_outputs_atomically(
+                        lambda tmp: generate_rendition_variants(
+                            clean_input, [{name: tmp[p] for name, p in outputs.items()} for outputs in variant_outputs],
+                            orientation, task, num_transforms, quality, recipes),
+                        [p for outputs in variant_outputs for p in outputs.values()])
+                    checkpoint('renditions', written,
+                               [(recipe, outputs.values()) for recipe, outputs in zip(recipes, variant_outputs)])
+                    continue
                 except Exception as e:
-                    print(f"Error processing variant: {str(e)}")
+                    print(f"Renditions failed, falling back to single-rendition encoding: {str(e)}")
+                    strategy = plan_variant_encodes(clean_input, count, fanout, segment_seconds)
+
+            out_paths = [os.path.join(output_dir, f"{number}.mp4") for number in numbers]
+
+            if strategy == 'bitstream':
+                # No encode at all: every copy is one remux with bitstream-level changes
+                sampled = False
+                for variant, out_path in enumerate(out_paths):
+                    recipe = recipes[variant]
+                    print(f"\n[PROCESS] Bitstream variant {variant + 1}/{count}: {fname} => {os.path.basename(out_path)}")
                     try:
-                        print("Attempting to save copy of original...")
-                        cmd = [
-                            "ffmpeg", "-y", "-nostdin",
-                            "-i", in_path,
-                            "-c", "copy",
-                            out_path
-                        ]
-                        subprocess.run(cmd, check=True)
-                        if os.path.exists(out_path) and os.path.getsize(out_path) > 0:
-                            print(f"Successfully saved copy of original => {out_path}")
-                            successful_outputs.append(out_path)
-                        else:
-                            print(f"Failed to save copy: file is missing or empty")
-                            if task:
-                                task.update_state(state='FAILURE', meta={'status': 'Failed to save video', 'error': 'Generated file is missing or empty'})
+                        written = write_outputs_atomically(
+                            lambda tmp: generate_bitstream_variant(clean_input, tmp[out_path], recipe.seed, task),
+                            [out_path])
+                        checkpoint('bitstream', written, [(recipe, [out_path])])
                     except Exception as e:
-                        print(f"Failed to save copy: {str(e)}")
-                        if task:
-                            task.update_state(state='FAILURE', meta={'status': f'Failed to save video: {str(e)}', 'error': str(e)})
+                        print(f"Bitstream variant failed, encoding instead: {str(e)}")
+                        if not sampled and not can_stream_copy(clean_input):
+                            quality = resolve_quality(clean_input, quality_target, quality_metric, content_hash, task)
+                            sampled = True
+                        mode = encode_variant(clean_input, in_path, out_path, recipe, task, segment_seconds, quality)
+                        if mode:
+                            checkpoint(mode, [out_path], [(recipe, [out_path])])
+                continue
+
+            if strategy == 'fanout':
+                # Decode once and write every variant from the same ffmpeg process
+                print(f"\n[PROCESS] Fan-out {count} variants: {fname} => {[os.path.basename(p) for p in out_paths]}")
+                try:
+                    written = write_outputs_atomically(
+                        lambda tmp: generate_unique_variants(clean_input, [tmp[p] for p in out_paths], orientation,
+                                                             task, num_transforms, quality, recipes),
+                        out_paths)
+                    checkpoint('fanout', written, [(recipe, [p]) for recipe, p in zip(recipes, out_paths)])
+                    continue
+                except Exception as e:
+                    print(f"Fan-out failed, falling back to per-variant encoding: {str(e)}")
+
+            if strategy == 'concurrent':
+                # Independent variants overlap as concurrent ffmpeg processes
+                print(f"\n[PROCESS] {count} concurrent variants: {fname} => {[os.path.basename(p) for p in out_paths]}")
+                copied = []
+
+                def produce(tmp):
+                    copies = []
+                    generate_variants_concurrently(clean_input, [tmp[p] for p in out_paths], orientation, task,
+                                                   num_transforms, quality, fallback_input=in_path, recipes=recipes,
+                                                   copied=copies)
+                    copied.extend(p for p in out_paths if tmp[p] in copies)
+
+                written = write_outputs_atomically(produce, out_paths)
+                outputs = [(recipe, [p]) for recipe, p in zip(recipes, out_paths)]
+                checkpoint('variant', [p for p in written if p not in copied], outputs)
+                checkpoint('copy', [p for p in written if p in copied], outputs)
+                if len(written) < count and task:
+                    task.update_state(state='PROCESSING', meta={'status': f'Failed to save {count - len(written)} of {count} videos'})
+                continue
+
+            for variant, out_path in enumerate(out_paths):
+                print(f"\n[PROCESS] Variant {variant + 1}/{count}: {fname} => {os.path.basename(out_path)}")
+                mode = encode_variant(clean_input, in_path, out_path, recipes[variant], task, segment_seconds, quality)
+                if mode:
+                    checkpoint(mode, [out_path], [(recipes[variant], [out_path])])
 
     print("\nFinished main_modified processing")
     print(f"Successfully processed {len(successful_outputs)} files")
+
     print(f"Final contents of output directory: {os.listdir(output_dir)}")
     
     # Verify all output files
@@ -802,7 +2463,8 @@ def main_modified(input_dir, output_dir, num_variants=1, orientation='horizontal
             task.update_state(state='FAILURE', meta={'status': 'No files were successfully processed', 'error': 'No files were successfully processed'})
     else:
         if task:
-            task.update_state(state='SUCCESS', meta={'status': 'success', 'files': [os.path.basename(p) for p in successful_outputs]})
+            task.update_state(state='SUCCESS', meta={'status': 'success', 'files': [os.path.basename(p) for p in successful_outputs],
+                                                     'recipes': load_recipe_manifest(output_dir)})
 
 if __name__ == "__main__":
     input_dir = "./input"